@@ -0,0 +1,157 @@
+"""Measure per-request logging overhead before and after the queue-based logging layer.
+
+Each scenario drives a small FastAPI app in-process by calling it as an ASGI
+app, so the numbers isolate framework and logging cost from the network.
+Both logging scenarios run the same RequestLoggingMiddleware and the same
+handler log line; only the logging backend differs:
+
+* ``none``: no middleware and logging disabled, the baseline
+* ``before``: ``logging.basicConfig`` (format and write on the event loop) with an f-string ``logging.info``
+* ``after``: ``configure_logging`` (queue plus writer thread) with lazy ``%s`` arguments
+
+Log output goes to a pipe drained by ``cat``, like stderr captured by a
+container runtime, or to /dev/null with ``--sink devnull``; either way
+terminal speed does not skew the result.
+The writer thread's formatting still competes for the GIL, so besides the
+event loop's wall time the benchmark reports process CPU time, which
+includes the writer thread until it has drained the queue. The best of
+several interleaved rounds is reported to dampen noise.
+
+    python benchmark_logging.py --requests 20000 --sample-rate 0.1
+"""
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import time
+
+from fastapi import FastAPI
+
+from request_logging import (
+    ContextQueueHandler,
+    RequestLoggingMiddleware,
+    configure_logging,
+    disable_record_introspection,
+)
+
+
+def build_app(scenario: str, sample_rate: float) -> FastAPI:
+    app = FastAPI()
+
+    if scenario == "before":
+        @app.get("/api/environments")
+        async def environments():
+            name = "benchmark"
+            logging.info(f"Created environment: {name}")
+            return {"name": name}
+    else:
+        @app.get("/api/environments")
+        async def environments():
+            name = "benchmark"
+            logging.info("Created environment: %s", name)
+            return {"name": name}
+
+    if scenario != "none":
+        app.add_middleware(RequestLoggingMiddleware, sample_rate=sample_rate)
+    return app
+
+
+async def drive(app, requests: int) -> float:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": "/api/environments", "raw_path": b"/api/environments",
+        "query_string": b"", "root_path": "", "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 1234), "server": ("127.0.0.1", 8001),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # Warm up routing and pydantic caches
+    for _ in range(100):
+        await app(dict(scope), receive, send)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sample-rate", type=float, default=0.1)
+    parser.add_argument("--rounds", type=int, default=3, help="best of N interleaved rounds is reported")
+    parser.add_argument("--sink", choices=("pipe", "devnull"), default="pipe",
+                        help="pipe mimics stderr captured by a container runtime")
+    args = parser.parse_args()
+
+    reader = None
+    if args.sink == "pipe":
+        reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+        stream = reader.stdin
+    else:
+        stream = open(os.devnull, "w")
+
+    root = logging.getLogger()
+    listener = None
+    introspection_defaults = {
+        name: getattr(logging, name)
+        for name in ("_srcfile", "logThreads", "logProcesses", "logMultiprocessing", "logAsyncioTasks")
+        if hasattr(logging, name)
+    }
+    results = {}
+
+    for _ in range(args.rounds):
+        for scenario in ("none", "before", "after"):
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+
+            if scenario == "after":
+                if listener is None:
+                    listener = configure_logging(level=logging.INFO, stream=stream)
+                else:
+                    disable_record_introspection()
+                    root.addHandler(ContextQueueHandler(listener.queue))
+                    root.setLevel(logging.INFO)
+            else:
+                for name, value in introspection_defaults.items():
+                    setattr(logging, name, value)
+                if scenario == "none":
+                    root.setLevel(logging.WARNING)
+                else:
+                    logging.basicConfig(level=logging.INFO, stream=stream, force=True)
+
+            app = build_app(scenario, args.sample_rate)
+            cpu_start = time.process_time()
+            elapsed = asyncio.run(drive(app, args.requests))
+            if scenario == "after":
+                # Include the time the writer thread needs to catch up
+                while not listener.queue.empty():
+                    time.sleep(0.001)
+            # Process CPU time covers the writer thread too, which holds the GIL while formatting
+            cpu = time.process_time() - cpu_start
+
+            best = results.get(scenario)
+            if best is None or cpu < best[1]:
+                results[scenario] = (elapsed, cpu)
+
+    wall_baseline = results["none"][0] / args.requests * 1e6
+    cpu_baseline = results["none"][1] / args.requests * 1e6
+    print(f"{'scenario':>8} {'loop us/req':>12} {'overhead':>9} {'cpu us/req':>11} {'overhead':>9}")
+    for scenario, (elapsed, cpu) in results.items():
+        wall = elapsed / args.requests * 1e6
+        cpu = cpu / args.requests * 1e6
+        print(f"{scenario:>8} {wall:>12.1f} {wall - wall_baseline:>9.1f} {cpu:>11.1f} {cpu - cpu_baseline:>9.1f}")
+
+    if reader is not None:
+        reader.stdin.close()
+        reader.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Measure request throughput of the API as the worker count grows.
+
+Starts the server with ``uvicorn --workers N`` for each requested worker
+count, drives it from several client processes for a fixed duration and
+prints requests per second. MongoDB is not required: by default the
+benchmark hits /api/health, which exercises the HTTP stack and middleware
+only.
+
+``--fake-docker-ms`` puts a stand-in ``docker`` executable first on the
+server's PATH that sleeps for the given time and prints an image list, so
+/api/docker/images goes through the real run_docker subprocess path without
+a Docker daemon:
+
+    python benchmark_workers.py --workers 1 2 4 --duration 5
+    python benchmark_workers.py --path /api/docker/images --fake-docker-ms 20
+
+The server runs as separate processes because worker scaling is across
+processes; a single in-process event loop cannot show it.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(port: int, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def client(port: int, path: str, duration: float, results):
+    completed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        # A fresh connection per request lets the kernel spread load across
+        # workers; a keep-alive connection would stay pinned to one of them
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request("GET", path)
+        conn.getresponse().read()
+        conn.close()
+        completed += 1
+    results.put(completed)
+
+
+def write_fake_docker(directory: str, delay_ms: float):
+    path = os.path.join(directory, "docker")
+    with open(path, "w") as f:
+        f.write(f"#!/bin/sh\nsleep {delay_ms / 1000:.3f}\necho REPOSITORY:TAG\necho nanobox/devstack:latest\n")
+    os.chmod(path, 0o755)
+
+
+def run(workers: int, clients: int, duration: float, path: str, fake_docker_dir: str = None) -> float:
+    port = free_port()
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers))
+    if fake_docker_dir:
+        env["PATH"] = fake_docker_dir + os.pathsep + env.get("PATH", "")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    try:
+        wait_until_ready(port)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=client, args=(port, path, duration, results))
+            for _ in range(clients)
+        ]
+        for proc in procs:
+            proc.start()
+        total = sum(results.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+        return total / duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--path", default="/api/health")
+    parser.add_argument("--fake-docker-ms", type=float, default=None,
+                        help="run docker endpoints against a stand-in docker that takes this long")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as fake_docker_dir:
+        if args.fake_docker_ms is not None:
+            write_fake_docker(fake_docker_dir, args.fake_docker_ms)
+        else:
+            fake_docker_dir = None
+
+        baseline = None
+        print(f"{'workers':>8} {'req/s':>10} {'speedup':>8}")
+        for workers in args.workers:
+            rate = run(workers, args.clients, args.duration, args.path, fake_docker_dir)
+            baseline = baseline or rate
+            print(f"{workers:>8} {rate:>10.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class LeaderElector:
+    """Lease-based leader election shared by every worker through MongoDB.
+
+    Each worker process competes for a single lease document. The holder
+    renews it every ``renew_interval`` seconds; if it dies, another worker
+    takes over once ``lease_seconds`` have passed without a renewal.
+    """
+
+    def __init__(self, collection, name: str = "background-tasks",
+                 lease_seconds: int = 30, renew_interval: int = 10):
+        self.collection = collection
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.renew_interval = renew_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        # Incremented every time this worker gains leadership
+        self.term = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def try_acquire(self) -> bool:
+        now = datetime.utcnow()
+        try:
+            lease = await self.collection.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [
+                        {"holder": self.worker_id},
+                        {"expires_at": {"$lt": now}},
+                    ],
+                },
+                {
+                    "$set": {
+                        "holder": self.worker_id,
+                        "expires_at": now + timedelta(seconds=self.lease_seconds),
+                        "renewed_at": now,
+                    }
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The lease exists and is held by another live worker
+            lease = None
+
+        was_leader = self.is_leader
+        self.is_leader = bool(lease) and lease.get("holder") == self.worker_id
+        if self.is_leader and not was_leader:
+            self.term += 1
+        if self.is_leader != was_leader:
+            logging.info(
+                "Worker %s %s leadership of %s",
+                self.worker_id, "acquired" if self.is_leader else "lost", self.name,
+            )
+        return self.is_leader
+
+    async def _run(self):
+        while True:
+            try:
+                await self.try_acquire()
+            except Exception as e:
+                # Without a reachable database we cannot prove we still hold the lease
+                self.is_leader = False
+                logging.error("Leader election failed: %s", e)
+            await asyncio.sleep(self.renew_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self.is_leader:
+            try:
+                await self.collection.delete_one({"_id": self.name, "holder": self.worker_id})
+            except Exception as e:
+                logging.error("Failed to release leadership of %s: %s", self.name, e)
+            self.is_leader = False
+
+
+class BackgroundTaskRunner:
+    """Runs periodic tasks, but only in the worker that currently holds the lease"""
+
+    def __init__(self, elector: LeaderElector):
+        self.elector = elector
+        self._jobs: Dict[str, tuple] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def register(self, name: str, interval: float, job: Callable[[], Awaitable[None]]):
+        self._jobs[name] = (interval, job)
+
+    async def _loop(self, name: str, interval: float, job: Callable[[], Awaitable[None]]):
+        while True:
+            await asyncio.sleep(interval)
+            if not self.elector.is_leader:
+                continue
+            try:
+                await job()
+            except Exception as e:
+                logging.error("Background task %s failed: %s", name, e)
+
+    def start(self):
+        self.elector.start()
+        for name, (interval, job) in self._jobs.items():
+            if name not in self._tasks:
+                self._tasks[name] = asyncio.create_task(self._loop(name, interval, job))
+
+    async def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+        await self.elector.stop()
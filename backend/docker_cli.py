@@ -0,0 +1,64 @@
+import asyncio
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from timing import timed
+
+
+class DockerResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+async def run_docker(*args: str) -> DockerResult:
+    """Run a docker CLI command without blocking the event loop"""
+    with timed("docker"):
+        process = await asyncio.create_subprocess_exec(
+            "docker", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    return DockerResult(
+        returncode=process.returncode,
+        stdout=stdout.decode(errors="replace"),
+        stderr=stderr.decode(errors="replace"),
+    )
+
+
+class InspectResult(NamedTuple):
+    states: Dict[str, str]
+    missing: Set[str]
+    error: Optional[str]
+
+
+async def inspect_containers(container_ids: List[str]) -> InspectResult:
+    """Look up the state of several containers with a single ``docker inspect``.
+
+    ``states`` maps each requested id to its state, ``missing`` holds ids the
+    daemon reports as nonexistent, and ``error`` carries any other failure;
+    ids in neither ``states`` nor ``missing`` have an unknown state.
+    """
+    result = await run_docker("inspect", "--format", "{{.Id}} {{.State.Status}}", *container_ids)
+
+    states = {}
+    for line in result.stdout.splitlines():
+        full_id, _, state = line.strip().partition(" ")
+        for container_id in container_ids:
+            if full_id.startswith(container_id) or container_id.startswith(full_id):
+                states[container_id] = state
+
+    missing = set()
+    other_errors = []
+    for line in result.stderr.splitlines():
+        if "No such object" in line or "No such container" in line:
+            missing_id = line.rsplit(":", 1)[-1].strip()
+            if missing_id in container_ids:
+                missing.add(missing_id)
+        elif line.strip():
+            other_errors.append(line.strip())
+
+    error = None
+    if result.returncode != 0 and (other_errors or len(states) + len(missing) < len(container_ids)):
+        error = "; ".join(other_errors) or f"docker inspect exited with {result.returncode}"
+    return InspectResult(states=states, missing=missing, error=error)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from docker_cli import run_docker
+
+# Labels stamped on every container we start, used to find our orphans;
+# DEPLOYMENT_LABEL holds the database name so deployments sharing a Docker
+# daemon never sweep each other's containers
+INSTANCE_LABEL = "nanobox.instance"
+DEPLOYMENT_LABEL = "nanobox.db"
+
+DUPLICATE_KEY_ERROR = 11000
+INDEX_OPTIONS_CONFLICT = 85
+
+# Collections whose stale documents are moved to a "<name>_archive" collection
+ARCHIVED_COLLECTIONS = ("environments", "docker_instances")
+
+
+class GarbageCollector:
+    """Archives stale environments and Docker instances and removes containers nobody owns.
+
+    Stopped environments idle for longer than ``env_ttl_seconds`` and stopped
+    Docker instances idle for longer than ``instance_ttl_seconds`` are moved
+    to ``<collection>_archive`` in batches, after the stopped instances'
+    containers are removed; the archives expire after ``archive_ttl_seconds``
+    through a TTL index, so no collection grows without bound. Containers
+    labelled with this ``deployment`` and an instance id that no longer
+    exists in ``docker_instances`` are force-removed concurrently.
+    """
+
+    def __init__(self, db, deployment: str, env_ttl_seconds: int, archive_ttl_seconds: int,
+                 instance_ttl_seconds: Optional[int] = None, batch_size: int = 500, concurrency: int = 8):
+        self.db = db
+        self.deployment = deployment
+        self.env_ttl_seconds = env_ttl_seconds
+        self.instance_ttl_seconds = instance_ttl_seconds if instance_ttl_seconds is not None else env_ttl_seconds
+        self.archive_ttl_seconds = archive_ttl_seconds
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._indexes_ready = False
+
+    async def _ensure_ttl_index(self, collection_name: str):
+        try:
+            await self.db[collection_name].create_index(
+                "archived_at", expireAfterSeconds=self.archive_ttl_seconds
+            )
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # ARCHIVE_TTL_SECONDS changed since the index was created
+            await self.db.command(
+                "collMod", collection_name,
+                index={"keyPattern": {"archived_at": 1}, "expireAfterSeconds": self.archive_ttl_seconds},
+            )
+
+    async def ensure_indexes(self):
+        if self._indexes_ready:
+            return
+        for name in ARCHIVED_COLLECTIONS:
+            await self._ensure_ttl_index(f"{name}_archive")
+        await self.db.environments.create_index([("status", 1), ("updated_at", 1)])
+        await self.db.docker_instances.create_index([("status", 1), ("updated_at", 1)])
+        self._indexes_ready = True
+
+    async def _archive(self, name: str, query: dict) -> int:
+        """Move documents matching ``query`` from ``name`` to ``<name>_archive`` in batches"""
+        source = self.db[name]
+        archive = self.db[f"{name}_archive"]
+
+        archived = 0
+        while True:
+            batch = await source.find(query).limit(self.batch_size).to_list(self.batch_size)
+            if not batch:
+                break
+
+            now = datetime.utcnow()
+            for doc in batch:
+                doc["archived_at"] = now
+            try:
+                await archive.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Documents already archived by an interrupted earlier run are fine
+                if any(err["code"] != DUPLICATE_KEY_ERROR for err in e.details.get("writeErrors", [])):
+                    raise
+
+            ids = [doc["_id"] for doc in batch]
+            # Re-check the full query so documents touched since the find are kept
+            result = await source.delete_many({"$and": [{"_id": {"$in": ids}}, query]})
+            archived += result.deleted_count
+            if result.deleted_count < len(ids):
+                survivors = [doc["_id"] async for doc in source.find({"_id": {"$in": ids}}, {"_id": 1})]
+                if survivors:
+                    await archive.delete_many({"_id": {"$in": survivors}})
+            if len(batch) < self.batch_size:
+                break
+
+        if archived:
+            logging.info("Archived %s stale documents from %s", archived, name)
+        return archived
+
+    async def archive_stale_environments(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.env_ttl_seconds)
+        return await self._archive("environments", {
+            "status": "stopped",
+            "$or": [
+                {"updated_at": {"$lt": cutoff}},
+                # Environments created before updated_at was tracked
+                {"updated_at": {"$exists": False}, "created_at": {"$lt": cutoff}},
+            ],
+        })
+
+    async def remove_stale_containers(self) -> int:
+        """Remove the stopped containers of instances idle past the TTL so they can be archived"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.instance_ttl_seconds)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def remove(instance: dict) -> bool:
+            container_id = instance["container_id"]
+            async with semaphore:
+                # No -f: a container that is running after all is left alone
+                result = await run_docker("rm", container_id)
+            if result.returncode != 0 and "No such container" not in result.stderr:
+                logging.error("Failed to remove stale container %s: %s", container_id, result.stderr)
+                return False
+            # Leave updated_at alone so the instance is archived in this run;
+            # an instance restarted meanwhile has a new container_id and is skipped
+            updated = await self.db.docker_instances.update_one(
+                {"_id": instance["_id"], "container_id": container_id, "status": "stopped"},
+                {"$set": {"container_id": None}},
+            )
+            return updated.modified_count == 1
+
+        removed = 0
+        last_id = None
+        while True:
+            query = {"status": "stopped", "container_id": {"$ne": None}, "updated_at": {"$lt": cutoff}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await self.db.docker_instances.find(
+                query, {"container_id": 1}
+            ).sort("_id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not batch:
+                break
+            removed += sum(await asyncio.gather(*(remove(instance) for instance in batch)))
+            last_id = batch[-1]["_id"]
+            if len(batch) < self.batch_size:
+                break
+
+        if removed:
+            logging.info("Removed %s containers of stale stopped instances", removed)
+        return removed
+
+    async def archive_stale_instances(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.instance_ttl_seconds)
+        return await self._archive("docker_instances", {
+            "status": "stopped",
+            "container_id": None,
+            "updated_at": {"$lt": cutoff},
+        })
+
+    async def remove_orphaned_containers(self) -> int:
+        result = await run_docker(
+            "ps", "-a", "--filter", f"label={INSTANCE_LABEL}",
+            "--filter", f"label={DEPLOYMENT_LABEL}={self.deployment}",
+            "--format", f'{{{{.ID}}}} {{{{.Label "{INSTANCE_LABEL}"}}}}',
+        )
+        if result.returncode != 0:
+            logging.error("Failed to list containers: %s", result.stderr)
+            return 0
+
+        containers = {}
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                containers[parts[0]] = parts[1]
+        if not containers:
+            return 0
+
+        known = set()
+        instance_ids = list(set(containers.values()))
+        for start in range(0, len(instance_ids), self.batch_size):
+            chunk = instance_ids[start:start + self.batch_size]
+            async for instance in self.db.docker_instances.find({"id": {"$in": chunk}}, {"id": 1}):
+                known.add(instance["id"])
+
+        orphans = [cid for cid, instance_id in containers.items() if instance_id not in known]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def remove(container_id: str) -> bool:
+            async with semaphore:
+                removed = await run_docker("rm", "-f", container_id)
+            if removed.returncode != 0:
+                logging.error("Failed to remove orphaned container %s: %s", container_id, removed.stderr)
+            return removed.returncode == 0
+
+        results = await asyncio.gather(*(remove(cid) for cid in orphans))
+        if orphans:
+            logging.info("Removed %s of %s orphaned containers", sum(results), len(orphans))
+        return sum(results)
+
+    async def run(self):
+        await self.ensure_indexes()
+        await self.archive_stale_environments()
+        await self.remove_stale_containers()
+        await self.archive_stale_instances()
+        await self.remove_orphaned_containers()
@@ -0,0 +1,524 @@
+import asyncio
+import base64
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from docker_cli import run_docker
+
+# Segment layout:
+#   [zlib block 0][zlib block 1]...
+#   [block table: BLOCK_ENTRY per block]
+#   [token bytes][postings: u32 block ids][token directory: DIR_ENTRY per token]
+#   [footer]
+# The token directory is sorted by token bytes, so a reader binary-searches it
+# straight from the mmap and never materialises the index in memory.
+SEGMENT_MAGIC = b"NBLOG002"
+SEGMENT_FOOTER = struct.Struct("<QIQI8s")
+BLOCK_ENTRY = struct.Struct("<QIdd")
+DIR_ENTRY = struct.Struct("<QIQI")
+POSTING = struct.Struct("<I")
+SEGMENT_SUFFIX = ".seg"
+TMP_SUFFIX = ".tmp"
+BLOCK_BYTES = 64 * 1024
+# A segment still being written after this long was abandoned by a crash
+STALE_TMP_SECONDS = 3600
+
+TOKEN_RE = re.compile(r"\w+")
+INSTANCE_ID_RE = re.compile(r"^[\w-]+$")
+
+
+def tokenize(text: str) -> set:
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+def to_epoch(value: datetime) -> float:
+    """Naive datetimes are treated as UTC, like every timestamp we store"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def parse_docker_timestamp(value: str) -> float:
+    """Parse the RFC3339Nano timestamp that ``docker logs --timestamps`` prints"""
+    value = value.rstrip("Z")
+    base, _, fraction = value.partition(".")
+    seconds = datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    return seconds + float(f"0.{fraction[:6] or 0}")
+
+
+def write_segment(path: str, records: List[Tuple[float, str]], block_bytes: int = BLOCK_BYTES):
+    """Write time-ordered ``(timestamp, line)`` records as an immutable segment"""
+    blocks = []
+    tokens: Dict[str, List[int]] = {}
+    tmp_path = f"{path}{TMP_SUFFIX}"
+
+    with open(tmp_path, "wb") as f:
+        offset = 0
+        start = 0
+        while start < len(records):
+            size = 0
+            end = start
+            while end < len(records) and (size < block_bytes or end == start):
+                size += len(records[end][1]) + 18
+                end += 1
+            block = records[start:end]
+            block_id = len(blocks)
+
+            data = zlib.compress("".join(f"{ts:.6f}\t{line}\n" for ts, line in block).encode())
+            f.write(data)
+            blocks.append(BLOCK_ENTRY.pack(offset, len(data), block[0][0], block[-1][0]))
+            offset += len(data)
+
+            for _, line in block:
+                for token in tokenize(line):
+                    postings = tokens.setdefault(token, [])
+                    if not postings or postings[-1] != block_id:
+                        postings.append(block_id)
+            start = end
+
+        block_table_offset = offset
+        f.write(b"".join(blocks))
+        offset += BLOCK_ENTRY.size * len(blocks)
+
+        directory = []
+        for token in sorted(tokens, key=lambda t: t.encode()):
+            encoded = token.encode()
+            f.write(encoded)
+            token_offset = offset
+            offset += len(encoded)
+            postings = tokens[token]
+            f.write(struct.pack(f"<{len(postings)}I", *postings))
+            directory.append(DIR_ENTRY.pack(token_offset, len(encoded), offset, len(postings)))
+            offset += POSTING.size * len(postings)
+
+        directory_offset = offset
+        f.write(b"".join(directory))
+        f.write(SEGMENT_FOOTER.pack(block_table_offset, len(blocks), directory_offset, len(directory), SEGMENT_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """Read-only view of a segment file through mmap"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = self._data[-SEGMENT_FOOTER.size:]
+        if len(footer) != SEGMENT_FOOTER.size:
+            self.close()
+            raise ValueError(f"Not a log segment: {path}")
+        (self._block_table, self.block_count,
+         self._directory, self.token_count, magic) = SEGMENT_FOOTER.unpack(footer)
+        if magic != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError(f"Not a log segment: {path}")
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def block(self, block_id: int) -> Tuple[int, int, float, float]:
+        """``(offset, length, min_ts, max_ts)`` of a block"""
+        return BLOCK_ENTRY.unpack_from(self._data, self._block_table + block_id * BLOCK_ENTRY.size)
+
+    def read_block(self, block_id: int) -> List[Tuple[float, str]]:
+        offset, length, _, _ = self.block(block_id)
+        rows = []
+        for row in zlib.decompress(self._data[offset:offset + length]).decode().splitlines():
+            ts_text, _, line = row.partition("\t")
+            rows.append((float(ts_text), line))
+        return rows
+
+    def postings(self, token: str) -> List[int]:
+        """Block ids containing ``token``, by binary search over the token directory"""
+        target = token.encode()
+        low, high = 0, self.token_count
+        while low < high:
+            middle = (low + high) // 2
+            token_offset, token_length, postings_offset, count = DIR_ENTRY.unpack_from(
+                self._data, self._directory + middle * DIR_ENTRY.size
+            )
+            candidate = self._data[token_offset:token_offset + token_length]
+            if candidate == target:
+                return list(struct.unpack_from(f"<{count}I", self._data, postings_offset))
+            if candidate < target:
+                low = middle + 1
+            else:
+                high = middle
+        return []
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor; raises ValueError for anything it did not produce"""
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (
+        isinstance(key, list) and len(key) == 5
+        and isinstance(key[0], (int, float)) and not isinstance(key[0], bool)
+        and isinstance(key[1], str) and isinstance(key[2], str)
+        and all(isinstance(part, int) and not isinstance(part, bool) for part in key[3:])
+    ):
+        raise ValueError("Malformed cursor")
+    return tuple(key)
+
+
+def parse_segment_name(name: str) -> Optional[Tuple[float, float]]:
+    """Time range of a ``<min_us>-<max_us>-<suffix>.seg`` file, or None for other names"""
+    if not name.endswith(SEGMENT_SUFFIX):
+        return None
+    try:
+        min_us, max_us, _ = name[:-len(SEGMENT_SUFFIX)].split("-", 2)
+        return int(min_us) / 1e6, int(max_us) / 1e6
+    except ValueError:
+        return None
+
+
+class LogIndex:
+    """On-disk store of compressed, token-indexed log segments.
+
+    Segments live at ``<root>/<instance_id>/<min_us>-<max_us>-<suffix>.seg``,
+    so instance and time-range pruning only needs a directory listing; term
+    pruning uses each segment's inverted index. Total size is capped at
+    ``max_bytes`` by dropping the oldest segments.
+    """
+
+    def __init__(self, root: str, segment_bytes: int, max_bytes: int):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _instance_dirs(self, instance_id: Optional[str]) -> List[str]:
+        if instance_id is not None:
+            if not INSTANCE_ID_RE.match(instance_id):
+                return []
+            return [instance_id]
+        return [name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name))]
+
+    def segments(self, instance_id: Optional[str] = None, since: Optional[float] = None,
+                 until: Optional[float] = None) -> List[tuple]:
+        """Segments overlapping the time range, newest first"""
+        found = []
+        for instance in self._instance_dirs(instance_id):
+            directory = os.path.join(self.root, instance)
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                time_range = parse_segment_name(name)
+                if time_range is None:
+                    continue
+                min_ts, max_ts = time_range
+                if since is not None and max_ts < since:
+                    continue
+                if until is not None and min_ts > until:
+                    continue
+                found.append((max_ts, min_ts, instance, name, os.path.join(directory, name)))
+        found.sort(reverse=True)
+        return found
+
+    def add(self, instance_id: str, records: List[Tuple[float, str]]):
+        """Persist time-ordered records as one or more segments"""
+        directory = os.path.join(self.root, instance_id)
+        os.makedirs(directory, exist_ok=True)
+
+        start = 0
+        while start < len(records):
+            size = 0
+            end = start
+            while end < len(records) and size < self.segment_bytes:
+                size += len(records[end][1]) + 18
+                end += 1
+            chunk = records[start:end]
+            name = f"{int(chunk[0][0] * 1e6)}-{int(chunk[-1][0] * 1e6)}-{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+            write_segment(os.path.join(directory, name), chunk)
+            start = end
+
+    def enforce_retention(self) -> int:
+        """Drop the oldest segments beyond ``max_bytes``, abandoned temp files and empty directories"""
+        segments = self.segments()
+        sizes = {}
+        for segment in segments:
+            try:
+                sizes[segment[4]] = os.path.getsize(segment[4])
+            except FileNotFoundError:
+                sizes[segment[4]] = 0
+        total = sum(sizes.values())
+
+        stale_before = time.time() - STALE_TMP_SECONDS
+        for instance in self._instance_dirs(None):
+            directory = os.path.join(self.root, instance)
+            for name in os.listdir(directory):
+                if not name.endswith(TMP_SUFFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < stale_before:
+                        os.remove(path)
+                    else:
+                        # Being written right now; it still takes up space
+                        total += stat.st_size
+                except FileNotFoundError:
+                    pass
+
+        removed = 0
+        for segment in reversed(segments):
+            if total <= self.max_bytes:
+                break
+            path = segment[4]
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= sizes[path]
+            removed += 1
+
+        for instance in self._instance_dirs(None):
+            try:
+                os.rmdir(os.path.join(self.root, instance))
+            except OSError:
+                # Not empty
+                pass
+        return removed
+
+    def search(self, term: Optional[str] = None, instance_id: Optional[str] = None,
+               since: Optional[float] = None, until: Optional[float] = None,
+               limit: int = 100, cursor: Optional[str] = None) -> dict:
+        """Newest-first matches for ``term``, paginated by an opaque cursor"""
+        needle = term.lower() if term else None
+        tokens = tokenize(term) if term else set()
+        before = decode_cursor(cursor) if cursor else None
+        upper = until
+        if before is not None:
+            upper = before[0] if upper is None else min(upper, before[0])
+
+        candidates = self.segments(instance_id, since, upper)
+        results = []
+        scanned = 0
+
+        for max_ts, _, instance, name, path in candidates:
+            if len(results) >= limit and max_ts < results[limit - 1][0][0]:
+                break
+            scanned += 1
+
+            try:
+                segment = Segment(path)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            with segment:
+                block_ids = None
+                for token in tokens:
+                    postings = set(segment.postings(token))
+                    block_ids = postings if block_ids is None else block_ids & postings
+                    if not block_ids:
+                        break
+                if block_ids is None:
+                    block_ids = range(segment.block_count)
+
+                for block_id in sorted(block_ids):
+                    _, _, block_min, block_max = segment.block(block_id)
+                    if (since is not None and block_max < since) or (upper is not None and block_min > upper):
+                        continue
+                    for line_no, (ts, line) in enumerate(segment.read_block(block_id)):
+                        if (since is not None and ts < since) or (until is not None and ts > until):
+                            continue
+                        if needle and needle not in line.lower():
+                            continue
+                        key = (ts, instance, name, block_id, line_no)
+                        if before is not None and key >= before:
+                            continue
+                        results.append((key, line))
+
+            if len(results) > limit:
+                results.sort(reverse=True)
+                del results[limit + 1:]
+            elif len(results) == limit:
+                results.sort(reverse=True)
+
+        results.sort(reverse=True)
+        has_more = len(results) > limit or scanned < len(candidates)
+        page = results[:limit]
+
+        return {
+            "results": [
+                {"instance_id": key[1], "timestamp": datetime.utcfromtimestamp(key[0]), "line": line}
+                for key, line in page
+            ],
+            "next_cursor": encode_cursor(page[-1][0]) if has_more and page else None,
+            "segments_scanned": scanned,
+        }
+
+
+class LogIngester:
+    """Tails container logs into a LogIndex.
+
+    Lines are buffered per instance and written as a segment once the buffer
+    reaches the segment size or ``flush_interval`` seconds have passed, so
+    search lags live output by at most that long. The last flushed timestamp
+    per instance is persisted next to the segments. Each time this worker
+    wins a new leadership term it discards its buffers and reloads those
+    cursors, so it resumes exactly where the previous leader last flushed;
+    lines a lost leader had only buffered are read again from Docker.
+    Cursors of instances deleted from ``docker_instances`` are dropped.
+    """
+
+    def __init__(self, db, index: LogIndex, elector, flush_interval: float,
+                 backfill_lines: int = 10000, concurrency: int = 8, batch_size: int = 500):
+        self.db = db
+        self.index = index
+        self.elector = elector
+        self.flush_interval = flush_interval
+        self.backfill_lines = backfill_lines
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.cursor_path = os.path.join(index.root, "cursors.json")
+        self._term = None
+        self._flushed: Dict[str, float] = {}
+        self._read: Dict[str, float] = {}
+        self._buffers: Dict[str, List[Tuple[float, str]]] = {}
+        self._buffer_bytes: Dict[str, int] = {}
+        self._buffer_started: Dict[str, float] = {}
+
+    def _load_cursors(self) -> Dict[str, float]:
+        try:
+            with open(self.cursor_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    async def _prune_cursors(self) -> bool:
+        """Forget cursors of instances deleted from ``docker_instances``"""
+        ids = [instance_id for instance_id in self._flushed if instance_id not in self._buffers]
+        known = set()
+        for start in range(0, len(ids), self.batch_size):
+            chunk = ids[start:start + self.batch_size]
+            for instance in await self.db.docker_instances.find({"id": {"$in": chunk}}, {"id": 1}).to_list(None):
+                known.add(instance["id"])
+
+        deleted = [instance_id for instance_id in ids if instance_id not in known]
+        for instance_id in deleted:
+            del self._flushed[instance_id]
+            self._read.pop(instance_id, None)
+        return bool(deleted)
+
+    def _save_cursors(self):
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._flushed, f)
+        os.replace(tmp_path, self.cursor_path)
+
+    def _start_term(self, term: int):
+        self._term = term
+        self._flushed = self._load_cursors()
+        self._read = dict(self._flushed)
+        self._buffers.clear()
+        self._buffer_bytes.clear()
+        self._buffer_started.clear()
+
+    async def _ingest(self, instance: dict):
+        instance_id = instance["id"]
+        last = self._read.get(instance_id)
+        if last is None:
+            # First sight of this instance: backfill a bounded amount of history
+            args = ["logs", "--timestamps", "--tail", str(self.backfill_lines)]
+        else:
+            args = ["logs", "--timestamps", "--since", f"{last:.6f}"]
+        result = await run_docker(*args, instance["container_id"])
+        if result.returncode != 0:
+            return
+
+        records = []
+        for row in (result.stdout + result.stderr).splitlines():
+            ts_text, _, line = row.partition(" ")
+            try:
+                ts = parse_docker_timestamp(ts_text)
+            except ValueError:
+                continue
+            if last is None or ts > last:
+                records.append((ts, line))
+        if not records:
+            return
+
+        records.sort()
+        buffer = self._buffers.setdefault(instance_id, [])
+        buffer.extend(records)
+        self._buffer_bytes[instance_id] = self._buffer_bytes.get(instance_id, 0) + sum(len(line) for _, line in records)
+        self._buffer_started.setdefault(instance_id, asyncio.get_running_loop().time())
+        self._read[instance_id] = records[-1][0]
+
+    def _flush(self, now: float, save_cursors: bool = False):
+        flushed = False
+        for instance_id in list(self._buffers):
+            due = (self._buffer_bytes[instance_id] >= self.index.segment_bytes
+                   or now - self._buffer_started[instance_id] >= self.flush_interval)
+            if not due:
+                continue
+            records = self._buffers.pop(instance_id)
+            del self._buffer_bytes[instance_id]
+            del self._buffer_started[instance_id]
+            self.index.add(instance_id, records)
+            self._flushed[instance_id] = records[-1][0]
+            flushed = True
+
+        if flushed or save_cursors:
+            self._save_cursors()
+        if flushed:
+            removed = self.index.enforce_retention()
+            if removed:
+                logging.info("Dropped %s log segments to stay within the size limit", removed)
+
+    async def run(self):
+        if self._term != self.elector.term:
+            self._start_term(self.elector.term)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def ingest(instance: dict):
+            async with semaphore:
+                try:
+                    await self._ingest(instance)
+                except Exception as e:
+                    logging.error("Failed to ingest logs for %s: %s", instance["id"], e)
+
+        last_id = None
+        while True:
+            query = {"container_id": {"$ne": None}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            instances = await self.db.docker_instances.find(
+                query, {"id": 1, "container_id": 1}
+            ).sort("_id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not instances:
+                break
+            await asyncio.gather(*(ingest(instance) for instance in instances))
+            last_id = instances[-1]["_id"]
+            if len(instances) < self.batch_size:
+                break
+
+        # Never write buffers or cursors from a term this worker no longer leads
+        if self.elector.is_leader and self.elector.term == self._term:
+            pruned = await self._prune_cursors()
+            await asyncio.to_thread(self._flush, asyncio.get_running_loop().time(), pruned)
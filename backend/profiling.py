@@ -0,0 +1,524 @@
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+from request_logging import request_id_var
+from timing import TIMINGS_SCOPE_KEY, request_timings_var, summarize_timings, timed, timed_await
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _write_text(path: str, text: str):
+    """Replace ``path`` atomically so readers in other workers never see a partial file.
+
+    The directory is created on first write, so a read-only deployment only
+    loses profiling rather than failing to start.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _write_json(path: str, data):
+    _write_text(path, json.dumps(data, default=_json_default))
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Another worker got there first
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TimedCursor:
+    """Motor cursor proxy that times every awaited call as Mongo time"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if result is self._cursor:
+                # Chained modifiers such as limit() and sort() return the cursor
+                return self
+            if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+                return timed_await("mongo", result)
+            return result
+        return call
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        with timed("mongo"):
+            return await self._cursor.next()
+
+
+class TimedCollection:
+    """Motor collection proxy that times every awaited call as Mongo time"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+                return timed_await("mongo", result)
+            if hasattr(result, "to_list"):
+                return TimedCursor(result)
+            return result
+        return call
+
+
+class TimedDatabase:
+    """Motor database proxy whose collections are TimedCollections"""
+
+    def __init__(self, database):
+        self._database = database
+
+    def __getattr__(self, name):
+        attr = getattr(self._database, name)
+        if hasattr(attr, "find_one"):
+            return TimedCollection(attr)
+        # Database-level helpers such as command() pass through untimed
+        return attr
+
+    def __getitem__(self, name):
+        return TimedCollection(self._database[name])
+
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with timed("serialization"):
+            return super().render(content)
+
+
+class TimedResponseField:
+    """Response model field proxy that counts validation and dumping as serialization time"""
+
+    def __init__(self, field):
+        self._field = field
+
+    def __getattr__(self, name):
+        return getattr(self._field, name)
+
+    def validate(self, *args, **kwargs):
+        with timed("serialization"):
+            return self._field.validate(*args, **kwargs)
+
+    def serialize(self, *args, **kwargs):
+        with timed("serialization"):
+            return self._field.serialize(*args, **kwargs)
+
+
+class TimedRoute(APIRoute):
+    """Route class that times response model validation as serialization.
+
+    Use with ``APIRouter(route_class=TimedRoute)``; encoding the JSON body is
+    timed separately by TimedJSONResponse.
+    """
+
+    def get_route_handler(self):
+        if self.secure_cloned_response_field is not None and not isinstance(
+            self.secure_cloned_response_field, TimedResponseField
+        ):
+            self.secure_cloned_response_field = TimedResponseField(self.secure_cloned_response_field)
+        return super().get_route_handler()
+
+
+class SlowRequestStore:
+    """Slow request captures shared by all workers that use ``directory``.
+
+    Each worker keeps its latest ``maxlen`` captures in its own
+    ``slow-requests-<pid>.json``; recent() merges every worker's file and
+    deletes those of workers that have exited, so workers must share a PID
+    namespace (one host or container).
+    """
+
+    def __init__(self, directory: str, maxlen: int = 100):
+        self.directory = directory
+        self._captures = collections.deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, capture: dict):
+        with self._lock:
+            self._captures.append(capture)
+            _write_json(os.path.join(self.directory, f"slow-requests-{os.getpid()}.json"), list(self._captures))
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        captures = []
+        for path in glob.glob(os.path.join(self.directory, "slow-requests-*.json")):
+            pid = os.path.basename(path)[len("slow-requests-"):-len(".json")]
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                _remove(path)
+                continue
+            captures.extend(_read_json(path) or ())
+        captures.sort(key=lambda capture: capture["timestamp"], reverse=True)
+        return captures[:limit]
+
+
+class ProfilingMiddleware:
+    """Tracks per-request Mongo, Docker and serialization time and keeps the
+    most recent requests slower than ``slow_request_ms`` for inspection.
+
+    The raw timings are left in the scope for RequestLoggingMiddleware to put
+    on the access record. Must sit inside RequestLoggingMiddleware so captures
+    carry the request id.
+    """
+
+    def __init__(self, app, captures: SlowRequestStore, slow_request_ms: float = 1000):
+        self.app = app
+        self.captures = captures
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, list] = {}
+        scope[TIMINGS_SCOPE_KEY] = timings
+        token = request_timings_var.set(timings)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_timings_var.reset(token)
+            duration_ms = (time.perf_counter() - start) * 1000
+            if duration_ms >= self.slow_request_ms:
+                await self._capture(scope, status, duration_ms, timings)
+
+    async def _capture(self, scope, status: int, duration_ms: float, timings: Dict[str, list]):
+        breakdown, calls = summarize_timings(timings, duration_ms)
+        route = scope.get("route")
+        capture = {
+            "request_id": request_id_var.get(),
+            "timestamp": datetime.utcnow(),
+            "method": scope["method"],
+            "route": getattr(route, "path", scope["path"]),
+            "path": scope["path"],
+            "status": status,
+            "duration_ms": round(duration_ms, 2),
+            "breakdown": breakdown,
+            "calls": calls,
+            "worker_pid": os.getpid(),
+        }
+        try:
+            await asyncio.to_thread(self.captures.add, capture)
+        except OSError as e:
+            logging.error("Failed to save slow request capture: %s", e)
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples every thread's stack from a background thread.
+
+    Output is in the folded-stack format (``frame;frame;frame count``) read
+    by flamegraph.pl, speedscope and inferno. Samples only the worker process
+    it runs in; SharedProfiler runs one per worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.samples = 0
+        self.interval = 0.0
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval: float = 0.01):
+        with self._lock:
+            if self.running:
+                raise RuntimeError("Profiler is already running")
+            self._stacks = collections.Counter()
+            self._stop.clear()
+            self.samples = 0
+            self.interval = interval
+            self.started_at = datetime.utcnow()
+            self.finished_at = None
+            self._thread = threading.Thread(
+                target=self._run, args=(time.monotonic() + seconds, interval),
+                name="sampling-profiler", daemon=True,
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, deadline: float, interval: float):
+        own_id = threading.get_ident()
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            self._stop.wait(interval)
+        self.finished_at = datetime.utcnow()
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "worker_pid": os.getpid(),
+        }
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+
+class SharedProfiler:
+    """Runs a SamplingProfiler in every worker that shares ``directory``.
+
+    start_profile() and stop_profile() write a command file that each
+    worker's poll loop applies to its own profiler; workers publish their
+    status and folded stacks to files keyed by pid, which status() and
+    folded() merge. Call start() in every worker to run the poll loop.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 1.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.profiler = SamplingProfiler()
+        self._command_id: Optional[str] = None
+        self._published = True
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _read_command(self) -> Optional[dict]:
+        return _read_json(self._path("profiler-command.json"))
+
+    @staticmethod
+    def _active(command: Optional[dict]) -> bool:
+        return command is not None and not command["stopped"] and command["deadline"] > time.time()
+
+    def start_profile(self, seconds: float, interval: float = 0.01):
+        """Ask every worker to sample its stacks for ``seconds``"""
+        if self._active(self._read_command()):
+            raise RuntimeError("Profiler is already running")
+        for path in glob.glob(self._path("profile-*.folded")) + glob.glob(self._path("profiler-status-*.json")):
+            _remove(path)
+        _write_json(self._path("profiler-command.json"), {
+            "id": uuid.uuid4().hex,
+            "interval": interval,
+            "deadline": time.time() + seconds,
+            "stopped": False,
+        })
+        self.poll()
+
+    def stop_profile(self):
+        """Ask every worker to stop sampling early"""
+        command = self._read_command()
+        if self._active(command):
+            command["stopped"] = True
+            _write_json(self._path("profiler-command.json"), command)
+        self.poll()
+
+    def poll(self):
+        """Apply the current command to this worker's profiler and publish its results"""
+        with self._lock:
+            command = self._read_command()
+            if command is not None and command["id"] != self._command_id:
+                self.profiler.stop()
+                self._command_id = command["id"]
+                if self._active(command):
+                    self.profiler.start(command["deadline"] - time.time(), interval=command["interval"])
+                    self._published = False
+            elif self.profiler.running and not self._active(command):
+                self.profiler.stop()
+
+            if not self._published:
+                running = self.profiler.running
+                if not running:
+                    path = self._path(f"profile-{self._command_id}-{os.getpid()}.folded")
+                    _write_text(path, self.profiler.folded())
+                    self._published = True
+                _write_json(
+                    self._path(f"profiler-status-{os.getpid()}.json"),
+                    {**self.profiler.status(), "running": running, "command_id": self._command_id},
+                )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception as e:
+                logging.error("Profiler poll failed: %s", e)
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.profiler.stop)
+
+    def status(self) -> dict:
+        command = self._read_command()
+        if command is None:
+            return {"running": False, "workers": []}
+        workers = []
+        for path in glob.glob(self._path("profiler-status-*.json")):
+            status = _read_json(path)
+            if status is not None and status["command_id"] == command["id"]:
+                workers.append(status)
+        return {
+            "running": self._active(command),
+            "interval_ms": command["interval"] * 1000,
+            "deadline": datetime.utcfromtimestamp(command["deadline"]),
+            "stopped": command["stopped"],
+            "samples": sum(worker["samples"] for worker in workers),
+            "workers": sorted(workers, key=lambda worker: worker["worker_pid"]),
+        }
+
+    def folded(self) -> str:
+        """Folded stacks from every worker's finished run, merged"""
+        command = self._read_command()
+        if command is None:
+            return ""
+        stacks = collections.Counter()
+        for path in glob.glob(self._path(f"profile-{command['id']}-*.folded")):
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    if stack and count.isdigit():
+                        stacks[stack] += int(count)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+IMPORT_TIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+async def import_time_report(module: str = "server", top: int = 25, timeout: float = 60) -> dict:
+    """Import ``module`` in a fresh interpreter under ``-X importtime``.
+
+    Reports the slowest modules by cumulative and by self time, which is
+    what each new worker pays at boot. Raises asyncio.TimeoutError, after
+    killing the child, if the import takes longer than ``timeout`` seconds.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-X", "importtime", "-c", f"import {module}",
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+
+    modules = []
+    total_us = 0
+    for line in stderr.decode(errors="replace").splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = (len(indent) - 1) // 2
+        if depth == 0:
+            total_us += int(cumulative_us)
+        modules.append({
+            "module": name,
+            "depth": depth,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+
+    return {
+        "module": module,
+        "returncode": process.returncode,
+        "total_ms": total_us / 1000,
+        "by_cumulative": sorted(modules, key=lambda m: m["cumulative_ms"], reverse=True)[:top],
+        "by_self": sorted(modules, key=lambda m: m["self_ms"], reverse=True)[:top],
+    }
+
+
+if __name__ == "__main__":
+    report = asyncio.run(import_time_report(*sys.argv[1:2]))
+    print(f"Importing {report['module']} took {report['total_ms']:.1f}ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for entry in report["by_cumulative"]:
+        print(f"{entry['cumulative_ms']:>14.1f} {entry['self_ms']:>9.1f}  {'  ' * entry['depth']}{entry['module']}")
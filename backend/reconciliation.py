@@ -0,0 +1,57 @@
+import logging
+from datetime import datetime
+
+from docker_cli import inspect_containers
+
+# Docker states that do not map one-to-one onto DockerInstanceStatus
+DOCKER_STATE_MAP = {
+    "created": "stopped",
+    "exited": "stopped",
+    "removing": "stopped",
+}
+
+
+async def reconcile_docker_instances(collection, batch_size: int = 200):
+    """Sync stored Docker instance status with what the Docker daemon reports.
+
+    Updates are conditional on the container id seen at inspect time, so an
+    instance restarted onto a new container meanwhile is left alone.
+    """
+    last_id = None
+    while True:
+        query = {"container_id": {"$ne": None}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        instances = await collection.find(
+            query, {"id": 1, "container_id": 1, "status": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not instances:
+            break
+
+        inspected = await inspect_containers([instance["container_id"] for instance in instances])
+        if inspected.error:
+            # Daemon down, permission denied, etc.: leave documents alone for unknown containers
+            logging.error("Failed to inspect containers during reconcile: %s", inspected.error)
+
+        for instance in instances:
+            container_id = instance["container_id"]
+            if container_id in inspected.states:
+                state = inspected.states[container_id]
+                update = {"status": DOCKER_STATE_MAP.get(state, state)}
+            elif container_id in inspected.missing:
+                # The container no longer exists on this host
+                update = {"status": "stopped", "container_id": None}
+            else:
+                continue
+
+            if update["status"] != instance.get("status") or "container_id" in update:
+                update["updated_at"] = datetime.utcnow()
+                result = await collection.update_one(
+                    {"id": instance["id"], "container_id": container_id}, {"$set": update}
+                )
+                if result.modified_count:
+                    logging.info("Reconciled Docker instance %s: %s", instance["id"], update["status"])
+
+        last_id = instances[-1]["_id"]
+        if len(instances) < batch_size:
+            break
@@ -0,0 +1,269 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from timing import TIMINGS_SCOPE_KEY, summarize_timings
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+access_logger = logging.getLogger("nanobox.access")
+
+
+# Log arguments of these types can safely be formatted later on the writer thread
+_IMMUTABLE_ARG_TYPES = (str, int, float, type(None))
+
+_json_encoder = json.JSONEncoder(default=str)
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode_value(value) -> str:
+    if isinstance(value, str):
+        return _encode_string(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return repr(value)
+    return _json_encoder.encode(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra structured data goes in ``extra={"fields": {...}}``.
+
+    The line is assembled by hand because this runs for every record on the
+    writer thread while holding the GIL; only values that are not plain
+    strings or numbers go through the JSON encoder.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._second = None
+        self._second_prefix = ""
+
+    def _timestamp(self, created: float) -> str:
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._second_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        return f"{self._second_prefix}.{int((created - second) * 1e6):06d}Z"
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [
+            '{"timestamp": "', self._timestamp(record.created),
+            '", "level": "', record.levelname,
+            '", "logger": ', _encode_string(record.name),
+            ', "message": ', _encode_string(record.getMessage()),
+        ]
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            parts += (', "request_id": ', _encode_string(request_id))
+        fields = getattr(record, "fields", None)
+        if fields:
+            for key, value in fields.items():
+                parts += (", ", _encode_string(key), ": ", _encode_value(value))
+        if record.exc_info:
+            parts += (', "exception": ', _encode_string(self.formatException(record.exc_info)))
+        parts.append("}")
+        return "".join(parts)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, tagged with the current request id.
+
+    The stock QueueHandler formats the message in the calling thread and
+    takes the handler lock; here the record goes straight onto the
+    thread-safe queue, and formatting and the stderr write both happen on the
+    listener thread. Arguments other than strings and numbers are rendered
+    into the message here, since the caller may change them before the
+    writer gets to the record.
+    """
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        if self.filters and not self.filter(record):
+            return False
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(arg, _IMMUTABLE_ARG_TYPES) for arg in args)):
+            try:
+                record.msg = record.getMessage()
+            except Exception:
+                self.handleError(record)
+                return False
+            record.args = None
+        record.request_id = request_id_var.get()
+        self.queue.put_nowait(record)
+        return True
+
+
+class BatchingStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the listener, once per batch"""
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """Drains the queue in batches instead of waking up for every record.
+
+    Once the queue is empty the writer flushes its handlers and sleeps for
+    ``batch_interval`` seconds, so a busy event loop hands the GIL to the
+    writer thread a few dozen times a second rather than once per record.
+    """
+
+    def __init__(self, log_queue, *handlers, batch_interval: float = 0.02):
+        super().__init__(log_queue, *handlers, respect_handler_level=False)
+        self.batch_interval = batch_interval
+
+    def dequeue(self, block: bool):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for handler in self.handlers:
+            handler.flush()
+        time.sleep(self.batch_interval)
+        return self.queue.get(block)
+
+
+def disable_record_introspection():
+    """Stop the logging module collecting data JsonFormatter never emits.
+
+    Finding the caller's file and line walks the stack on every record, and
+    thread/process lookups add more; these are the switches the logging
+    HOWTO's "Optimization" section documents for this.
+    """
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    if hasattr(logging, "logAsyncioTasks"):
+        logging.logAsyncioTasks = False
+
+
+def configure_logging(level: int = logging.INFO, stream=None) -> logging.handlers.QueueListener:
+    """Route all logging through a queue drained by a background writer thread"""
+    disable_record_introspection()
+    log_queue = queue.SimpleQueue()
+
+    writer = BatchingStreamHandler(stream or sys.stderr)
+    writer.setFormatter(JsonFormatter())
+    listener = BatchingQueueListener(log_queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(ContextQueueHandler(log_queue))
+    root.setLevel(level)
+
+    # Uvicorn installs its own synchronous handlers; send its records through
+    # the queue instead, and drop its access log in favour of RequestLoggingMiddleware
+    for name in ("uvicorn", "uvicorn.error"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    logging.getLogger("uvicorn.access").disabled = True
+
+    return listener
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """Parse ``"/api/health=0,/api/environments=0.5"`` into a route -> rate map"""
+    rates = {}
+    for item in value.split(","):
+        route, _, rate = item.strip().partition("=")
+        if route and rate:
+            rates[route] = float(rate)
+    return rates
+
+
+class RequestLoggingMiddleware:
+    """Assigns a request id to every request and writes one access record per request.
+
+    Server errors and requests slower than ``slow_request_ms`` are always
+    logged; other requests are sampled at the rate configured for their
+    route template, falling back to ``sample_rate``. Records carry the
+    Mongo/Docker/serialization breakdown when ProfilingMiddleware runs inside.
+    """
+
+    def __init__(self, app, sample_rate: float = 0.1, route_sample_rates: Optional[Dict[str, float]] = None,
+                 slow_request_ms: float = 1000):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.route_sample_rates = route_sample_rates or {}
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        request_id = request_id or os.urandom(16).hex()
+        token = request_id_var.set(request_id)
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # Copy: the header list may belong to a Response that is sent again
+                header = (b"x-request-id", request_id.encode("latin-1"))
+                message["headers"] = [*message.get("headers", ()), header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        except Exception:
+            self._log(scope, 500, start, exc_info=True)
+            raise
+        else:
+            self._log(scope, status, start)
+        finally:
+            request_id_var.reset(token)
+
+    def _log(self, scope, status: int, start: float, exc_info: bool = False):
+        duration_ms = (time.perf_counter() - start) * 1000
+        route = scope.get("route")
+        path = getattr(route, "path", scope["path"])
+
+        if exc_info or status >= 500:
+            level = logging.ERROR
+        elif duration_ms >= self.slow_request_ms:
+            level = logging.WARNING
+        elif random.random() < self.route_sample_rates.get(path, self.sample_rate):
+            level = logging.INFO
+        else:
+            return
+
+        fields = {
+            "method": scope["method"],
+            "route": path,
+            "path": scope["path"],
+            "status": status,
+            "duration_ms": round(duration_ms, 2),
+        }
+        timings = scope.get(TIMINGS_SCOPE_KEY)
+        if timings is not None:
+            fields["breakdown"], fields["calls"] = summarize_timings(timings, duration_ms)
+        access_logger.log(
+            level,
+            "%s %s %s",
+            scope["method"], path, status,
+            exc_info=exc_info,
+            extra={"fields": fields},
+        )
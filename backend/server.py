@@ -1,18 +1,53 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
+import asyncio
+import functools
 import os
+import secrets
 import logging
 import uuid
 from enum import Enum
 
+from coordination import LeaderElector, BackgroundTaskRunner
+from docker_cli import run_docker
+from garbage_collection import DEPLOYMENT_LABEL, GarbageCollector, INSTANCE_LABEL
+from log_index import LogIndex, LogIngester, to_epoch
+from reconciliation import reconcile_docker_instances
+from request_logging import RequestLoggingMiddleware, configure_logging, parse_sample_rates
+from profiling import (
+    ProfilingMiddleware,
+    SharedProfiler,
+    SlowRequestStore,
+    TimedDatabase,
+    TimedJSONResponse,
+    TimedRoute,
+    import_time_report,
+)
+
+# Logging configuration
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.1))
+LOG_SAMPLE_RATES = parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", "/api/health=0"))
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 1000))
+
+# Profiling configuration; admin endpoints are disabled unless ADMIN_TOKEN is set.
+# Workers share PROFILE_DIR so the admin endpoints cover every worker
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+SLOW_REQUEST_CAPTURES = int(os.environ.get("SLOW_REQUEST_CAPTURES", 100))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILER_POLL_SECONDS = float(os.environ.get("PROFILER_POLL_SECONDS", 1))
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging(level=logging.INFO)
+
+app = FastAPI(title="Nanobox DevStack Manager", version="1.0.0", default_response_class=TimedJSONResponse)
 
-app = FastAPI(title="Nanobox DevStack Manager", version="1.0.0")
+profiler = SharedProfiler(PROFILE_DIR, poll_interval=PROFILER_POLL_SECONDS)
+slow_requests = SlowRequestStore(PROFILE_DIR, maxlen=SLOW_REQUEST_CAPTURES)
 
 # Add CORS middleware
 app.add_middleware(
@@ -23,14 +58,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Add per-request timing middleware (inside request logging, so captures carry the request id)
+app.add_middleware(ProfilingMiddleware, captures=slow_requests, slow_request_ms=SLOW_REQUEST_MS)
+
+# Add request id and access logging middleware
+app.add_middleware(
+    RequestLoggingMiddleware,
+    sample_rate=LOG_SAMPLE_RATE,
+    route_sample_rates=LOG_SAMPLE_RATES,
+    slow_request_ms=SLOW_REQUEST_MS,
+)
+
 # Database configuration
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("DB_NAME", "nanobox_devstack")
 
+# Worker and background task configuration
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", 30))
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get("RECONCILE_INTERVAL_SECONDS", 60))
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", 200))
+
+# Garbage collection configuration
+GC_INTERVAL_SECONDS = int(os.environ.get("GC_INTERVAL_SECONDS", 300))
+ENVIRONMENT_TTL_SECONDS = int(os.environ.get("ENVIRONMENT_TTL_SECONDS", 7 * 24 * 3600))
+INSTANCE_TTL_SECONDS = int(os.environ.get("INSTANCE_TTL_SECONDS", 7 * 24 * 3600))
+ARCHIVE_TTL_SECONDS = int(os.environ.get("ARCHIVE_TTL_SECONDS", 30 * 24 * 3600))
+GC_BATCH_SIZE = int(os.environ.get("GC_BATCH_SIZE", 500))
+
+# Log indexing configuration
+LOG_INDEX_DIR = os.environ.get("LOG_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "log_index"))
+LOG_SEGMENT_BYTES = int(os.environ.get("LOG_SEGMENT_BYTES", 8 * 1024 * 1024))
+LOG_INDEX_MAX_BYTES = int(os.environ.get("LOG_INDEX_MAX_BYTES", 1024 * 1024 * 1024))
+LOG_INGEST_INTERVAL_SECONDS = int(os.environ.get("LOG_INGEST_INTERVAL_SECONDS", 15))
+LOG_FLUSH_INTERVAL_SECONDS = int(os.environ.get("LOG_FLUSH_INTERVAL_SECONDS", 60))
+
 # Database connection
 client = None
 db = None
 environments_collection = None
+background_tasks = None
+log_index = None
 
 # Models
 class StatusCheck(BaseModel):
@@ -61,6 +129,7 @@ class Environment(BaseModel):
     status: EnvironmentStatus = EnvironmentStatus.stopped
     services: List[Service] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class EnvironmentCreate(BaseModel):
     name: str
@@ -92,18 +161,61 @@ class DockerInstanceCreate(BaseModel):
     environment_vars: Optional[Dict[str, str]] = {}
     volumes: Optional[Dict[str, str]] = {}
 
-# Database connection
-try:
-    client = AsyncIOMotorClient(MONGO_URL)
-    db = client[DB_NAME]
-    environments_collection = db.environments
-    print("✅ Connected to MongoDB successfully!")
-except Exception as e:
-    print(f"❌ Failed to connect to MongoDB: {e}")
-    environments_collection = None
+
+# Database connection (per worker process, so forked workers never share a client)
+@app.on_event("startup")
+async def startup():
+    global client, db, environments_collection, background_tasks, log_index
+    profiler.start()
+    try:
+        client = AsyncIOMotorClient(MONGO_URL)
+        db = TimedDatabase(client[DB_NAME])
+        environments_collection = db.environments
+        logging.info("Connected to MongoDB at %s", DB_NAME)
+    except Exception as e:
+        logging.error("Failed to connect to MongoDB: %s", e)
+        environments_collection = None
+        return
+
+    elector = LeaderElector(
+        db.leases,
+        lease_seconds=LEADER_LEASE_SECONDS,
+        renew_interval=max(1, LEADER_LEASE_SECONDS // 3),
+    )
+    background_tasks = BackgroundTaskRunner(elector)
+    background_tasks.register(
+        "reconcile-docker", RECONCILE_INTERVAL_SECONDS,
+        functools.partial(reconcile_docker_instances, db.docker_instances, batch_size=RECONCILE_BATCH_SIZE),
+    )
+    collector = GarbageCollector(
+        db,
+        deployment=DB_NAME,
+        env_ttl_seconds=ENVIRONMENT_TTL_SECONDS,
+        instance_ttl_seconds=INSTANCE_TTL_SECONDS,
+        archive_ttl_seconds=ARCHIVE_TTL_SECONDS,
+        batch_size=GC_BATCH_SIZE,
+    )
+    background_tasks.register("garbage-collect", GC_INTERVAL_SECONDS, collector.run)
+
+    try:
+        log_index = LogIndex(LOG_INDEX_DIR, segment_bytes=LOG_SEGMENT_BYTES, max_bytes=LOG_INDEX_MAX_BYTES)
+        ingester = LogIngester(db, log_index, elector, flush_interval=LOG_FLUSH_INTERVAL_SECONDS)
+        background_tasks.register("ingest-logs", LOG_INGEST_INTERVAL_SECONDS, ingester.run)
+    except OSError as e:
+        logging.error("Log indexing disabled, cannot use %s: %s", LOG_INDEX_DIR, e)
+        log_index = None
+    background_tasks.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await profiler.stop()
+    if background_tasks is not None:
+        await background_tasks.stop()
+    if client is not None:
+        client.close()
 
 # API Router
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", route_class=TimedRoute)
 
 @api_router.get("/")
 async def api_root():
@@ -129,7 +241,7 @@ async def get_status():
         status_checks = await environments_collection.find().to_list(1000)
         return status_checks
     except Exception as e:
-        logging.error(f"Failed to get status: {e}")
+        logging.error("Failed to get status: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/status")
@@ -143,7 +255,7 @@ async def create_status(status: StatusCheck):
         await environments_collection.insert_one(status_dict)
         return status
     except Exception as e:
-        logging.error(f"Failed to create status: {e}")
+        logging.error("Failed to create status: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Environment Management Endpoints
@@ -156,7 +268,7 @@ async def get_environments():
         environments = await db.environments.find().to_list(1000)
         return [Environment(**env) for env in environments]
     except Exception as e:
-        logging.error(f"Failed to get environments: {e}")
+        logging.error("Failed to get environments: %s", e)
         return []
 
 @api_router.post("/environments", response_model=Environment)
@@ -193,11 +305,11 @@ async def create_environment(env_data: EnvironmentCreate):
         env_dict = environment.dict()
         await environments_collection.insert_one(env_dict)
         
-        logging.info(f"Created environment: {environment.name}")
+        logging.info("Created environment: %s", environment.name)
         return environment
     
     except Exception as e:
-        logging.error(f"Failed to create environment: {e}")
+        logging.error("Failed to create environment: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create environment: {str(e)}")
 
 @api_router.put("/environments/{env_id}/start")
@@ -211,7 +323,8 @@ async def start_environment(env_id: str):
             {
                 "$set": {
                     "status": "running",
-                    "services.$[].status": "running"
+                    "services.$[].status": "running",
+                    "updated_at": datetime.utcnow()
                 }
             }
         )
@@ -224,7 +337,7 @@ async def start_environment(env_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to start environment: {e}")
+        logging.error("Failed to start environment: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to start environment: {str(e)}")
 
 @api_router.put("/environments/{env_id}/stop")
@@ -238,7 +351,8 @@ async def stop_environment(env_id: str):
             {
                 "$set": {
                     "status": "stopped",
-                    "services.$[].status": "stopped"
+                    "services.$[].status": "stopped",
+                    "updated_at": datetime.utcnow()
                 }
             }
         )
@@ -251,7 +365,7 @@ async def stop_environment(env_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to stop environment: {e}")
+        logging.error("Failed to stop environment: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to stop environment: {str(e)}")
 
 @api_router.delete("/environments/{env_id}")
@@ -270,7 +384,7 @@ async def delete_environment(env_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to delete environment: {e}")
+        logging.error("Failed to delete environment: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to delete environment: {str(e)}")
 
 @api_router.get("/services/{service_id}/logs")
@@ -295,7 +409,7 @@ async def get_docker_instances():
         instances = await db.docker_instances.find().to_list(1000)
         return [DockerInstance(**instance) for instance in instances]
     except Exception as e:
-        logging.error(f"Failed to get Docker instances: {e}")
+        logging.error("Failed to get Docker instances: %s", e)
         return []
 
 @api_router.post("/docker/instances", response_model=DockerInstance)
@@ -315,11 +429,11 @@ async def create_docker_instance(instance_data: DockerInstanceCreate):
         instance_dict = instance.dict()
         await db.docker_instances.insert_one(instance_dict)
         
-        logging.info(f"Created Docker instance: {instance.name}")
+        logging.info("Created Docker instance: %s", instance.name)
         return instance
         
     except Exception as e:
-        logging.error(f"Failed to create Docker instance: {e}")
+        logging.error("Failed to create Docker instance: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create Docker instance: {str(e)}")
 
 @api_router.put("/docker/instances/{instance_id}/start")
@@ -332,7 +446,11 @@ async def start_docker_instance(instance_id: str):
             raise HTTPException(status_code=404, detail="Docker instance not found")
         
         # Build docker run command
-        cmd = ["docker", "run", "-d", "--name", instance["name"]]
+        cmd = [
+            "run", "-d", "--name", instance["name"],
+            "--label", f"{INSTANCE_LABEL}={instance_id}",
+            "--label", f"{DEPLOYMENT_LABEL}={DB_NAME}",
+        ]
         
         # Add port mappings
         for container_port, host_port in instance.get("ports", {}).items():
@@ -350,7 +468,7 @@ async def start_docker_instance(instance_id: str):
         cmd.append(instance["image"])
         
         # Execute docker command
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = await run_docker(*cmd)
         
         if result.returncode == 0:
             container_id = result.stdout.strip()
@@ -374,7 +492,7 @@ async def start_docker_instance(instance_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to start Docker instance: {e}")
+        logging.error("Failed to start Docker instance: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to start Docker instance: {str(e)}")
 
 @api_router.put("/docker/instances/{instance_id}/stop")
@@ -390,7 +508,7 @@ async def stop_docker_instance(instance_id: str):
             raise HTTPException(status_code=400, detail="No running container found")
         
         # Stop the container
-        result = subprocess.run(["docker", "stop", instance["container_id"]], capture_output=True, text=True)
+        result = await run_docker("stop", instance["container_id"])
         
         if result.returncode == 0:
             # Update database
@@ -411,7 +529,7 @@ async def stop_docker_instance(instance_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to stop Docker instance: {e}")
+        logging.error("Failed to stop Docker instance: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to stop Docker instance: {str(e)}")
 
 @api_router.delete("/docker/instances/{instance_id}")
@@ -423,10 +541,12 @@ async def delete_docker_instance(instance_id: str):
         if not instance:
             raise HTTPException(status_code=404, detail="Docker instance not found")
         
-        # Stop and remove container if it exists
+        # Stop and remove the container first; if that fails keep the document,
+        # since unlabelled containers would never be found by the orphan sweep
         if instance.get("container_id"):
-            subprocess.run(["docker", "stop", instance["container_id"]], capture_output=True)
-            subprocess.run(["docker", "rm", instance["container_id"]], capture_output=True)
+            removed = await run_docker("rm", "-f", instance["container_id"])
+            if removed.returncode != 0 and "No such container" not in removed.stderr:
+                raise HTTPException(status_code=500, detail=f"Failed to remove container: {removed.stderr}")
         
         # Remove from database
         result = await db.docker_instances.delete_one({"id": instance_id})
@@ -439,7 +559,7 @@ async def delete_docker_instance(instance_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Failed to delete Docker instance: {e}")
+        logging.error("Failed to delete Docker instance: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to delete Docker instance: {str(e)}")
 
 @api_router.get("/docker/instances/{instance_id}/logs")
@@ -455,10 +575,7 @@ async def get_docker_logs(instance_id: str):
             return {"logs": ["Container not running"], "instance_id": instance_id}
         
         # Get container logs
-        result = subprocess.run(
-            ["docker", "logs", "--tail", "100", instance["container_id"]], 
-            capture_output=True, text=True
-        )
+        result = await run_docker("logs", "--tail", "100", instance["container_id"])
         
         if result.returncode == 0:
             logs = result.stdout.split('\n') if result.stdout else []
@@ -467,15 +584,43 @@ async def get_docker_logs(instance_id: str):
             return {"logs": [f"Error getting logs: {result.stderr}"], "instance_id": instance_id}
             
     except Exception as e:
-        logging.error(f"Failed to get Docker logs: {e}")
+        logging.error("Failed to get Docker logs: %s", e)
         return {"logs": [f"Error: {str(e)}"], "instance_id": instance_id}
 
+@api_router.get("/logs/search")
+async def search_logs(
+    q: Optional[str] = None,
+    instance_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+):
+    """Search indexed container logs, newest first"""
+    if log_index is None:
+        raise HTTPException(status_code=503, detail="Log index unavailable")
+
+    try:
+        return await asyncio.to_thread(
+            log_index.search,
+            term=q,
+            instance_id=instance_id,
+            since=to_epoch(since) if since else None,
+            until=to_epoch(until) if until else None,
+            limit=limit,
+            cursor=cursor,
+        )
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search parameters: {str(e)}")
+    except Exception as e:
+        logging.error("Failed to search logs: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to search logs: {str(e)}")
+
 @api_router.get("/docker/images")
 async def get_docker_images():
     """Get available Docker images"""
     try:
-        result = subprocess.run(["docker", "images", "--format", "table {{.Repository}}:{{.Tag}}"], 
-                              capture_output=True, text=True)
+        result = await run_docker("images", "--format", "table {{.Repository}}:{{.Tag}}")
         
         if result.returncode == 0:
             images = [line.strip() for line in result.stdout.split('\n')[1:] if line.strip()]
@@ -484,13 +629,84 @@ async def get_docker_images():
             return {"images": []}
             
     except Exception as e:
-        logging.error(f"Failed to get Docker images: {e}")
+        logging.error("Failed to get Docker images: %s", e)
         return {"images": []}
         
+# Admin Endpoints
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    # Compare bytes: compare_digest rejects str with non-ASCII characters
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+admin_router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+@admin_router.get("/profiler")
+async def get_profiler_status():
+    """Get the sampling profiler status across all workers"""
+    return await asyncio.to_thread(profiler.status)
+
+@admin_router.post("/profiler/start")
+async def start_profiler(
+    seconds: float = Query(30, gt=0, le=300),
+    interval_ms: float = Query(10, ge=1, le=1000),
+):
+    """Start sampling every worker's stacks for a fixed duration"""
+    try:
+        await asyncio.to_thread(profiler.start_profile, seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except OSError as e:
+        logging.error("Cannot start profiler in %s: %s", PROFILE_DIR, e)
+        raise HTTPException(status_code=503, detail=f"Profiling unavailable: {str(e)}")
+    return await asyncio.to_thread(profiler.status)
+
+@admin_router.post("/profiler/stop")
+async def stop_profiler():
+    """Stop the sampling profiler early in every worker"""
+    await asyncio.to_thread(profiler.stop_profile)
+    return await asyncio.to_thread(profiler.status)
+
+@admin_router.get("/profiler/flamegraph")
+async def get_profiler_flamegraph():
+    """Download collected samples from all workers as folded stacks for flamegraph tools.
+
+    Workers publish their samples within PROFILER_POLL_SECONDS of the run ending.
+    """
+    return PlainTextResponse(
+        await asyncio.to_thread(profiler.folded),
+        headers={"Content-Disposition": "attachment; filename=profile.folded"},
+    )
+
+@admin_router.get("/slow-requests")
+async def get_slow_requests(limit: int = Query(50, ge=1, le=1000)):
+    """Get the most recent slow requests captured by any worker"""
+    return {"requests": await asyncio.to_thread(slow_requests.recent, limit)}
+
+@admin_router.get("/import-times")
+async def get_import_times(top: int = Query(25, ge=1, le=500)):
+    """Measure module import times for a fresh worker boot"""
+    try:
+        return await import_time_report("server", top=top)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timed out measuring import times")
+    except Exception as e:
+        logging.error("Failed to measure import times: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to measure import times: {str(e)}")
+
+api_router.include_router(admin_router)
+
 # Include the API router
 app.include_router(api_router)
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if WORKERS > 1:
+        # Multiple workers need an import string so each process builds its own app
+        uvicorn.run("server:app", host="0.0.0.0", port=port, workers=WORKERS, access_log=False)
+    else:
+        # log_config=None keeps uvicorn from replacing the queue-based handlers
+        uvicorn.run(app, host="0.0.0.0", port=port, access_log=False, log_config=None)
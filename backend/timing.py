@@ -0,0 +1,47 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+# Per-request time spent in each category, set by ProfilingMiddleware
+request_timings_var: ContextVar[Optional[Dict[str, list]]] = ContextVar("request_timings", default=None)
+
+TIMING_CATEGORIES = ("mongo", "docker", "serialization")
+
+# Scope key under which ProfilingMiddleware leaves the request's timings for
+# RequestLoggingMiddleware, which runs outside it
+TIMINGS_SCOPE_KEY = "nanobox.timings"
+
+
+@contextmanager
+def timed(category: str):
+    """Attribute the enclosed time to ``category`` for the current request, if any"""
+    timings = request_timings_var.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = timings.setdefault(category, [0.0, 0])
+        entry[0] += time.perf_counter() - start
+        entry[1] += 1
+
+
+async def timed_await(category: str, awaitable):
+    with timed(category):
+        return await awaitable
+
+
+def summarize_timings(timings: Dict[str, list], duration_ms: float) -> Tuple[Dict[str, float], Dict[str, int]]:
+    """Split a request's duration into per-category milliseconds and call counts"""
+    breakdown = {}
+    calls = {}
+    for category in TIMING_CATEGORIES:
+        elapsed, count = timings.get(category, (0.0, 0))
+        breakdown[f"{category}_ms"] = round(elapsed * 1000, 2)
+        calls[category] = count
+    # Concurrent awaits inside one request can overlap, so clamp at zero
+    breakdown["other_ms"] = round(max(0.0, duration_ms - sum(breakdown.values())), 2)
+    return breakdown, calls
@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+import docker_cli
+from coordination import LeaderElector
+from docker_cli import DockerResult, inspect_containers
+
+
+class FakeLeaseCollection:
+    """Just enough of a Motor collection for LeaderElector's lease queries"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def _matches(self, doc, query):
+        if doc["_id"] != query["_id"]:
+            return False
+        for clause in query["$or"]:
+            if "holder" in clause and doc.get("holder") == clause["holder"]:
+                return True
+            if "expires_at" in clause and doc.get("expires_at") < clause["expires_at"]["$lt"]:
+                return True
+        return False
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        doc = self.docs.get(query["_id"])
+        if doc is not None and self._matches(doc, query):
+            doc.update(update["$set"])
+            return dict(doc)
+        if doc is not None:
+            # An upsert on a taken _id collides with the existing document
+            raise DuplicateKeyError("duplicate key")
+        doc = {"_id": query["_id"], **update["$set"]}
+        self.docs[query["_id"]] = doc
+        return dict(doc)
+
+    async def delete_one(self, query):
+        doc = self.docs.get(query["_id"])
+        if doc is not None and doc.get("holder") == query["holder"]:
+            del self.docs[query["_id"]]
+
+
+def test_first_worker_acquires_and_second_is_refused():
+    collection = FakeLeaseCollection()
+    first = LeaderElector(collection, lease_seconds=30)
+    second = LeaderElector(collection, lease_seconds=30)
+
+    assert asyncio.run(first.try_acquire())
+    assert not asyncio.run(second.try_acquire())
+    # Renewing keeps the lease with the current holder
+    assert asyncio.run(first.try_acquire())
+    assert collection.docs["background-tasks"]["holder"] == first.worker_id
+
+
+def test_takeover_after_lease_expires():
+    collection = FakeLeaseCollection()
+    first = LeaderElector(collection, lease_seconds=30)
+    second = LeaderElector(collection, lease_seconds=30)
+    asyncio.run(first.try_acquire())
+
+    collection.docs["background-tasks"]["expires_at"] = datetime.utcnow() - timedelta(seconds=1)
+
+    assert asyncio.run(second.try_acquire())
+    assert not asyncio.run(first.try_acquire())
+    assert not first.is_leader
+
+
+def test_stop_releases_lease():
+    collection = FakeLeaseCollection()
+    elector = LeaderElector(collection)
+    asyncio.run(elector.try_acquire())
+
+    asyncio.run(elector.stop())
+
+    assert collection.docs == {}
+    assert not elector.is_leader
+
+
+def stub_docker(monkeypatch, result):
+    calls = []
+
+    async def run_docker(*args):
+        calls.append(args)
+        return result
+
+    monkeypatch.setattr(docker_cli, "run_docker", run_docker)
+    return calls
+
+
+def test_inspect_containers_batches_and_reports_missing(monkeypatch):
+    calls = stub_docker(monkeypatch, DockerResult(
+        returncode=1,
+        stdout="aaaa1111 running\nbbbb2222 exited\n",
+        stderr="Error: No such object: cccc3333\n",
+    ))
+
+    result = asyncio.run(inspect_containers(["aaaa", "bbbb2222", "cccc3333"]))
+
+    assert len(calls) == 1
+    assert result.states == {"aaaa": "running", "bbbb2222": "exited"}
+    assert result.missing == {"cccc3333"}
+    assert result.error is None
+
+
+def test_inspect_containers_daemon_failure_is_not_missing(monkeypatch):
+    stub_docker(monkeypatch, DockerResult(
+        returncode=1,
+        stdout="",
+        stderr="Cannot connect to the Docker daemon at unix:///var/run/docker.sock\n",
+    ))
+
+    result = asyncio.run(inspect_containers(["aaaa", "bbbb"]))
+
+    assert result.states == {}
+    assert result.missing == set()
+    assert "Cannot connect" in result.error
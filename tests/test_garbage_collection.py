@@ -0,0 +1,235 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import garbage_collection
+from docker_cli import DockerResult
+from garbage_collection import GarbageCollector
+
+MISSING = object()
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        value = doc.get(key, MISSING)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$lt" and not (value is not MISSING and value is not None and value < operand):
+                    return False
+                if op == "$gt" and not (value is not MISSING and value > operand):
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$ne" and value is not MISSING and value == operand:
+                    return False
+                if op == "$exists" and (value is not MISSING) != operand:
+                    return False
+        elif condition is None:
+            if value is not MISSING and value is not None:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs = sorted(self.docs, key=lambda doc: doc[key], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return [dict(doc) for doc in self.docs[:length]]
+
+    def __aiter__(self):
+        self._iter = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return dict(next(self._iter))
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+        self.indexes = []
+        self.on_find = None
+
+    def find(self, query=None, projection=None):
+        docs = [doc for doc in self.docs if matches(doc, query or {})]
+        if self.on_find:
+            self.on_find()
+        return FakeCursor(docs)
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(dict(doc) for doc in docs)
+
+    async def update_one(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                doc.update(update["$set"])
+                return SimpleNamespace(modified_count=1)
+        return SimpleNamespace(modified_count=0)
+
+    async def delete_many(self, query):
+        kept = [doc for doc in self.docs if not matches(doc, query)]
+        deleted = len(self.docs) - len(kept)
+        self.docs = kept
+        return SimpleNamespace(deleted_count=deleted)
+
+    async def create_index(self, keys, **options):
+        self.indexes.append((keys, options))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def old(days=30):
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def test_archives_stale_environments_in_batches():
+    db = FakeDatabase()
+    db.environments.docs = [
+        {"_id": i, "id": f"env-{i}", "status": "stopped", "updated_at": old()} for i in range(5)
+    ] + [
+        {"_id": 10, "id": "fresh", "status": "stopped", "updated_at": datetime.utcnow()},
+        {"_id": 11, "id": "running", "status": "running", "updated_at": old()},
+        {"_id": 12, "id": "legacy", "status": "stopped", "created_at": old()},
+    ]
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=86400, batch_size=2)
+
+    archived = asyncio.run(collector.archive_stale_environments())
+
+    assert archived == 6
+    assert sorted(doc["id"] for doc in db.environments.docs) == ["fresh", "running"]
+    assert len(db.environments_archive.docs) == 6
+    assert all("archived_at" in doc for doc in db.environments_archive.docs)
+
+
+def test_environment_restarted_during_archival_is_kept():
+    db = FakeDatabase()
+    db.environments.docs = [{"_id": 1, "id": "env", "status": "stopped", "updated_at": old()}]
+
+    def restart_and_stop():
+        db.environments.docs[0]["updated_at"] = datetime.utcnow()
+
+    db.environments.on_find = restart_and_stop
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=86400)
+
+    # The find returns the stale snapshot, but the document is touched before the delete
+    assert asyncio.run(collector.archive_stale_environments()) == 0
+    assert [doc["id"] for doc in db.environments.docs] == ["env"]
+    assert db.environments_archive.docs == []
+
+
+def test_archives_stopped_instances_without_containers():
+    db = FakeDatabase()
+    db.docker_instances.docs = [
+        {"_id": 1, "id": "gone", "status": "stopped", "container_id": None, "updated_at": old()},
+        {"_id": 2, "id": "attached", "status": "stopped", "container_id": "abc", "updated_at": old()},
+        {"_id": 3, "id": "recent", "status": "stopped", "container_id": None, "updated_at": datetime.utcnow()},
+    ]
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=86400)
+
+    assert asyncio.run(collector.archive_stale_instances()) == 1
+    assert [doc["id"] for doc in db.docker_instances_archive.docs] == ["gone"]
+
+
+def test_removes_stopped_containers_then_archives_instances(monkeypatch):
+    db = FakeDatabase()
+    db.docker_instances.docs = [
+        {"_id": 1, "id": "stale", "status": "stopped", "container_id": "c1", "updated_at": old()},
+        {"_id": 2, "id": "already-gone", "status": "stopped", "container_id": "c2", "updated_at": old()},
+        {"_id": 3, "id": "rm-fails", "status": "stopped", "container_id": "c3", "updated_at": old()},
+        {"_id": 4, "id": "recent", "status": "stopped", "container_id": "c4", "updated_at": datetime.utcnow()},
+        {"_id": 5, "id": "running", "status": "running", "container_id": "c5", "updated_at": old()},
+    ]
+    removed = []
+
+    async def run_docker(*args):
+        removed.append(args)
+        if args[-1] == "c2":
+            return DockerResult(1, "", "Error response from daemon: No such container: c2")
+        if args[-1] == "c3":
+            return DockerResult(1, "", "Error response from daemon: container is running")
+        return DockerResult(0, args[-1], "")
+
+    monkeypatch.setattr(garbage_collection, "run_docker", run_docker)
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=86400, batch_size=2)
+
+    assert asyncio.run(collector.remove_stale_containers()) == 2
+    assert sorted(removed) == [("rm", "c1"), ("rm", "c2"), ("rm", "c3")]
+    assert asyncio.run(collector.archive_stale_instances()) == 2
+    assert sorted(doc["id"] for doc in db.docker_instances_archive.docs) == ["already-gone", "stale"]
+    assert sorted(doc["id"] for doc in db.docker_instances.docs) == ["recent", "rm-fails", "running"]
+
+
+def test_removes_only_orphaned_containers(monkeypatch):
+    db = FakeDatabase()
+    db.docker_instances.docs = [{"_id": 1, "id": "known"}]
+    removed = []
+
+    async def run_docker(*args):
+        if args[0] == "ps":
+            # The daemon applies both label filters, so only this deployment's containers are listed
+            assert "label=nanobox.db=test" in args
+            return DockerResult(0, "c1 known\nc2 deleted\nc3 also-deleted\n", "")
+        removed.append(args[-1])
+        return DockerResult(0, "", "")
+
+    monkeypatch.setattr(garbage_collection, "run_docker", run_docker)
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=86400)
+
+    assert asyncio.run(collector.remove_orphaned_containers()) == 2
+    assert sorted(removed) == ["c2", "c3"]
+
+
+def test_ttl_conflict_updates_index_with_collmod():
+    from pymongo.errors import OperationFailure
+
+    db = FakeDatabase()
+    commands = []
+
+    async def conflicting_create_index(keys, **options):
+        raise OperationFailure("IndexOptionsConflict", code=85)
+
+    async def command(*args, **kwargs):
+        commands.append((args, kwargs))
+
+    db.environments_archive.create_index = conflicting_create_index
+    db.docker_instances_archive.create_index = conflicting_create_index
+    db.command = command
+    collector = GarbageCollector(db, deployment="test", env_ttl_seconds=3600, archive_ttl_seconds=120)
+
+    asyncio.run(collector.ensure_indexes())
+
+    assert [args for args, _ in commands] == [
+        ("collMod", "environments_archive"), ("collMod", "docker_instances_archive"),
+    ]
+    assert commands[0][1]["index"]["expireAfterSeconds"] == 120
@@ -0,0 +1,230 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import log_index
+from docker_cli import DockerResult
+from log_index import LogIndex, LogIngester, Segment, decode_cursor, encode_cursor, write_segment
+
+
+def make_records(count, start=1000.0, error_every=7, suffix=""):
+    return [
+        (start + i, f"line {i} {'ERROR boom' if i % error_every == 0 else 'ok'}{suffix}")
+        for i in range(count)
+    ]
+
+
+def test_segment_round_trip_and_postings(tmp_path):
+    path = str(tmp_path / "segment.seg")
+    records = make_records(500)
+    write_segment(path, records, block_bytes=1024)
+
+    with Segment(path) as segment:
+        assert segment.block_count > 1
+        rows = [row for block_id in range(segment.block_count) for row in segment.read_block(block_id)]
+        assert rows == records
+
+        error_blocks = segment.postings("error")
+        assert error_blocks == sorted(set(error_blocks))
+        assert set(segment.postings("ok")) == set(range(segment.block_count))
+        assert segment.postings("missing") == []
+        assert segment.postings("") == []
+
+
+def test_rejects_files_that_are_not_segments(tmp_path):
+    path = tmp_path / "junk.seg"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        Segment(str(path))
+
+
+def test_token_pruning_only_reads_matching_blocks(tmp_path, monkeypatch):
+    index = LogIndex(str(tmp_path), segment_bytes=10 ** 6, max_bytes=10 ** 9)
+    records = [(1000.0 + i, f"line {i} {'needle' if i == 123 else 'hay'}") for i in range(2000)]
+    index.add("inst", records)
+
+    reads = []
+    original = Segment.read_block
+
+    def counting_read_block(self, block_id):
+        reads.append(block_id)
+        return original(self, block_id)
+
+    monkeypatch.setattr(Segment, "read_block", counting_read_block)
+    result = index.search("needle")
+
+    assert [row["line"] for row in result["results"]] == ["line 123 needle"]
+    assert len(reads) == 1
+
+
+def test_time_range_skips_segments(tmp_path):
+    index = LogIndex(str(tmp_path), segment_bytes=2000, max_bytes=10 ** 9)
+    index.add("inst", make_records(1000))
+    assert len(index.segments()) > 3
+
+    result = index.search(since=1500, until=1510, limit=100)
+
+    assert len(result["results"]) == 11
+    assert result["segments_scanned"] <= 2
+
+
+def test_cursor_pagination_is_complete_and_ordered(tmp_path):
+    index = LogIndex(str(tmp_path), segment_bytes=20000, max_bytes=10 ** 9)
+    index.add("a", make_records(2000, suffix=" a"))
+    index.add("b", make_records(2000, start=1000.5, suffix=" b"))
+
+    seen = []
+    cursor = None
+    while True:
+        page = index.search("error boom", limit=50, cursor=cursor)
+        seen.extend((row["instance_id"], row["timestamp"], row["line"]) for row in page["results"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert len(seen) == 2 * len(range(0, 2000, 7))
+    assert len(set(seen)) == len(seen)
+    timestamps = [timestamp for _, timestamp, _ in seen]
+    assert timestamps == sorted(timestamps, reverse=True)
+
+
+def test_retention_drops_oldest_segments(tmp_path):
+    index = LogIndex(str(tmp_path), segment_bytes=2000, max_bytes=10 ** 9)
+    index.add("inst", make_records(1000))
+    newest = index.segments()[0]
+
+    index.max_bytes = os.path.getsize(newest[4])
+    index.enforce_retention()
+
+    assert index.segments() == [newest]
+
+
+@pytest.mark.parametrize("key", [[], [1.0, "inst"], ["1", "inst", "a.seg", 0, 0], [1.0, "inst", "a.seg", 0, "0"], {}])
+def test_malformed_cursors_raise_value_error(key):
+    with pytest.raises(ValueError):
+        decode_cursor(base64.urlsafe_b64encode(json.dumps(key).encode()).decode())
+
+
+def test_cursor_round_trip():
+    key = (1700000000.5, "inst", "1-2-abc.seg", 3, 4)
+    assert decode_cursor(encode_cursor(key)) == key
+
+
+def test_unparseable_segment_names_are_skipped(tmp_path):
+    index = LogIndex(str(tmp_path), segment_bytes=10 ** 6, max_bytes=10 ** 9)
+    index.add("inst", make_records(10))
+    (tmp_path / "inst" / "notes.seg").write_bytes(b"")
+    (tmp_path / "inst" / "a-b-c.seg").write_bytes(b"")
+
+    assert len(index.segments()) == 1
+    assert len(index.search()["results"]) == 10
+
+
+def test_retention_removes_stale_temp_files_and_empty_directories(tmp_path):
+    index = LogIndex(str(tmp_path), segment_bytes=10 ** 6, max_bytes=10 ** 9)
+    index.add("inst", make_records(10))
+    (tmp_path / "gone").mkdir()
+    stale = tmp_path / "inst" / "1-2-dead.seg.tmp"
+    stale.write_bytes(b"x" * 100)
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+    fresh = tmp_path / "inst" / "3-4-live.seg.tmp"
+    fresh.write_bytes(b"x" * 100)
+
+    index.enforce_retention()
+
+    assert not stale.exists() and fresh.exists()
+    assert not (tmp_path / "gone").exists()
+
+    # A temp file being written still counts toward the size limit
+    index.max_bytes = os.path.getsize(index.segments()[0][4])
+    index.enforce_retention()
+    assert index.segments() == []
+    assert os.listdir(tmp_path / "inst") == ["3-4-live.seg.tmp"]
+
+
+class FakeInstanceCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return list(self.docs)
+
+
+class FakeInstances:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        docs = [doc for doc in self.docs if doc["_id"] > query.get("_id", {}).get("$gt", -1)]
+        if "id" in query:
+            docs = [doc for doc in docs if doc["id"] in query["id"]["$in"]]
+        return FakeInstanceCursor(docs)
+
+
+def test_new_leadership_term_resumes_from_flushed_cursor(tmp_path, monkeypatch):
+    calls = []
+
+    async def run_docker(*args):
+        calls.append(args)
+        return DockerResult(0, "2024-01-01T00:00:01.000000000Z hello\n2024-01-01T00:00:02.500000000Z world\n", "")
+
+    monkeypatch.setattr(log_index, "run_docker", run_docker)
+    db = SimpleNamespace(docker_instances=FakeInstances([{"_id": 1, "id": "inst", "container_id": "c1"}]))
+    elector = SimpleNamespace(term=1, is_leader=True)
+    index = LogIndex(str(tmp_path), segment_bytes=10 ** 6, max_bytes=10 ** 9)
+    ingester = LogIngester(db, index, elector, flush_interval=3600)
+
+    # Term 1 buffers the lines but never flushes them before losing the lease
+    asyncio.run(ingester.run())
+    assert "--tail" in calls[-1]
+    assert index.segments() == []
+
+    elector.is_leader = False
+    asyncio.run(ingester.run())
+    assert index.segments() == []
+
+    # Term 2 starts from the on-disk cursor (none), so the lines are read again
+    elector.term, elector.is_leader = 2, True
+    ingester.flush_interval = 0
+    asyncio.run(ingester.run())
+    assert "--tail" in calls[-1]
+    assert len(index.search()["results"]) == 2
+
+    # Later polls use --since without a tail limit
+    asyncio.run(ingester.run())
+    assert "--since" in calls[-1] and "--tail" not in calls[-1]
+    assert len(index.search()["results"]) == 2
+
+
+def test_cursors_of_deleted_instances_are_pruned(tmp_path, monkeypatch):
+    async def run_docker(*args):
+        return DockerResult(0, "2024-01-01T00:00:01.000000000Z hello\n", "")
+
+    monkeypatch.setattr(log_index, "run_docker", run_docker)
+    instances = FakeInstances([
+        {"_id": 1, "id": "kept", "container_id": "c1"},
+        {"_id": 2, "id": "deleted", "container_id": "c2"},
+    ])
+    db = SimpleNamespace(docker_instances=instances)
+    elector = SimpleNamespace(term=1, is_leader=True)
+    index = LogIndex(str(tmp_path), segment_bytes=10 ** 6, max_bytes=10 ** 9)
+    ingester = LogIngester(db, index, elector, flush_interval=0)
+
+    asyncio.run(ingester.run())
+    assert sorted(json.loads((tmp_path / "cursors.json").read_text())) == ["deleted", "kept"]
+
+    instances.docs = instances.docs[:1]
+    asyncio.run(ingester.run())
+    assert list(json.loads((tmp_path / "cursors.json").read_text())) == ["kept"]
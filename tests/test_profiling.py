@@ -0,0 +1,182 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from profiling import (
+    SharedProfiler,
+    SlowRequestStore,
+    TimedCollection,
+    TimedCursor,
+    TimedDatabase,
+    import_time_report,
+)
+from timing import request_timings_var, summarize_timings
+
+
+class FakeCursor:
+    """Motor-like cursor: modifiers return the cursor, fetches return futures"""
+
+    def __init__(self, docs):
+        self.docs = list(docs)
+        self.limited = None
+
+    def limit(self, n):
+        self.limited = n
+        return self
+
+    def to_list(self, length):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self.docs[:self.limited or length])
+        return future
+
+    async def next(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+
+class FakeCollection:
+    name = "environments"
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    async def find_one(self, query):
+        return self.docs[0] if self.docs else None
+
+    def find(self, query=None):
+        return FakeCursor(self.docs)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.environments = FakeCollection([{"id": 1}, {"id": 2}, {"id": 3}])
+
+    async def command(self, name):
+        return {"ok": 1}
+
+
+def with_timings(coro_fn):
+    async def run():
+        timings = {}
+        token = request_timings_var.set(timings)
+        try:
+            result = await coro_fn()
+        finally:
+            request_timings_var.reset(token)
+        return result, timings
+    return asyncio.run(run())
+
+
+def test_collection_calls_are_timed_as_mongo():
+    collection = TimedCollection(FakeCollection([{"id": 1}]))
+
+    result, timings = with_timings(lambda: collection.find_one({}))
+
+    assert result == {"id": 1}
+    assert timings["mongo"][1] == 1
+    assert collection.name == "environments"
+
+
+def test_cursor_chaining_and_to_list():
+    collection = TimedCollection(FakeCollection([{"id": 1}, {"id": 2}, {"id": 3}]))
+
+    async def query():
+        cursor = collection.find({}).limit(2)
+        assert isinstance(cursor, TimedCursor)
+        return await cursor.to_list(100)
+
+    result, timings = with_timings(query)
+
+    assert result == [{"id": 1}, {"id": 2}]
+    assert timings["mongo"][1] == 1
+
+
+def test_cursor_async_iteration_times_each_fetch():
+    database = TimedDatabase(FakeDatabase())
+
+    async def query():
+        return [doc async for doc in database.environments.find()]
+
+    result, timings = with_timings(query)
+
+    assert [doc["id"] for doc in result] == [1, 2, 3]
+    # Three documents plus the fetch that ends the iteration
+    assert timings["mongo"][1] == 4
+    assert asyncio.run(database.command("ping")) == {"ok": 1}
+
+
+def test_nothing_is_recorded_outside_a_request():
+    collection = TimedCollection(FakeCollection([{"id": 1}]))
+
+    assert asyncio.run(collection.find_one({})) == {"id": 1}
+    assert request_timings_var.get() is None
+
+
+def test_summarize_timings_clamps_other_time():
+    breakdown, calls = summarize_timings({"mongo": [0.003, 2], "docker": [0.004, 1]}, duration_ms=5)
+
+    assert breakdown == {"mongo_ms": 3.0, "docker_ms": 4.0, "serialization_ms": 0.0, "other_ms": 0.0}
+    assert calls == {"mongo": 2, "docker": 1, "serialization": 0}
+
+
+def test_slow_request_store_merges_workers(tmp_path):
+    store = SlowRequestStore(str(tmp_path), maxlen=2)
+    for n in range(3):
+        store.add({"request_id": f"own-{n}", "timestamp": f"2024-01-01T00:00:0{n * 2}"})
+    other = [{"request_id": "other", "timestamp": "2024-01-01T00:00:03"}]
+    (tmp_path / "slow-requests-1.json").write_text(json.dumps(other))  # init, always alive
+
+    assert [c["request_id"] for c in store.recent(10)] == ["own-2", "other", "own-1"]
+    assert [c["request_id"] for c in store.recent(1)] == ["own-2"]
+
+
+def test_shared_profiler_merges_worker_stacks(tmp_path):
+    profiler = SharedProfiler(str(tmp_path))
+
+    profiler.start_profile(5, interval=0.001)
+    status = profiler.status()
+    assert status["running"]
+    assert [worker["worker_pid"] for worker in status["workers"]] == [os.getpid()]
+
+    profiler.stop_profile()
+    command_id = json.loads((tmp_path / "profiler-command.json").read_text())["id"]
+    (tmp_path / f"profile-{command_id}-1.folded").write_text("MainThread;main (app.py:1) 3\n")
+    (tmp_path / "profile-stale-1.folded").write_text("MainThread;old (app.py:1) 99\n")
+
+    folded = profiler.folded()
+    assert "MainThread;main (app.py:1) 3\n" in folded
+    assert "old (app.py:1)" not in folded
+    assert not profiler.status()["running"]
+
+
+def test_slow_request_store_drops_exited_workers(tmp_path):
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    capture = [{"request_id": "ghost", "timestamp": "2024-01-01T00:00:00"}]
+    (tmp_path / f"slow-requests-{exited.pid}.json").write_text(json.dumps(capture))
+
+    assert SlowRequestStore(str(tmp_path)).recent(10) == []
+    assert not (tmp_path / f"slow-requests-{exited.pid}.json").exists()
+
+
+def test_profile_directory_is_created_on_first_write(tmp_path):
+    directory = tmp_path / "profiles"
+    store = SlowRequestStore(str(directory))
+    profiler = SharedProfiler(str(directory))
+
+    assert not directory.exists()
+    assert store.recent() == [] and profiler.folded() == ""
+    assert profiler.status() == {"running": False, "workers": []}
+
+    store.add({"request_id": "r", "timestamp": "2024-01-01T00:00:00"})
+    assert [c["request_id"] for c in store.recent()] == ["r"]
+
+
+def test_import_time_report_times_out():
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(import_time_report("server", timeout=0.001))
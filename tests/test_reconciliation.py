@@ -0,0 +1,101 @@
+import asyncio
+from types import SimpleNamespace
+
+import reconciliation
+from docker_cli import InspectResult
+from reconciliation import reconcile_docker_instances
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs = sorted(self.docs, key=lambda doc: doc[key])
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return [dict(doc) for doc in self.docs[:length]]
+
+
+class FakeInstances:
+    """Just enough of a Motor collection for reconcile's paging and conditional updates"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        docs = [doc for doc in self.docs if doc.get("container_id") is not None]
+        if "_id" in query:
+            docs = [doc for doc in docs if doc["_id"] > query["_id"]["$gt"]]
+        return FakeCursor(docs)
+
+    async def update_one(self, query, update):
+        for doc in self.docs:
+            if all(doc.get(key) == value for key, value in query.items()):
+                doc.update(update["$set"])
+                return SimpleNamespace(modified_count=1)
+        return SimpleNamespace(modified_count=0)
+
+
+def fake_inspect(monkeypatch, states=None, missing=(), error=None, during=None):
+    calls = []
+
+    async def inspect(container_ids):
+        calls.append(list(container_ids))
+        if during:
+            during()
+        return InspectResult(
+            states={cid: state for cid, state in (states or {}).items() if cid in container_ids},
+            missing={cid for cid in missing if cid in container_ids},
+            error=error,
+        )
+
+    monkeypatch.setattr(reconciliation, "inspect_containers", inspect)
+    return calls
+
+
+def test_only_missing_containers_are_detached(monkeypatch):
+    collection = FakeInstances([
+        {"_id": 1, "id": "a", "container_id": "c1", "status": "running"},
+        {"_id": 2, "id": "b", "container_id": "c2", "status": "running"},
+        {"_id": 3, "id": "c", "container_id": "c3", "status": "running"},
+    ])
+    # c3's state is unknown: inspect failed for a reason other than "No such container"
+    fake_inspect(monkeypatch, states={"c1": "exited"}, missing={"c2"}, error="permission denied")
+
+    asyncio.run(reconcile_docker_instances(collection))
+
+    a, b, c = collection.docs
+    assert (a["status"], a["container_id"]) == ("stopped", "c1")
+    assert (b["status"], b["container_id"]) == ("stopped", None)
+    assert (c["status"], c["container_id"]) == ("running", "c3")
+
+
+def test_instance_restarted_during_inspect_keeps_new_container(monkeypatch):
+    collection = FakeInstances([{"_id": 1, "id": "a", "container_id": "old", "status": "running"}])
+
+    def restart():
+        collection.docs[0].update(container_id="new", status="running")
+
+    fake_inspect(monkeypatch, missing={"old"}, during=restart)
+
+    asyncio.run(reconcile_docker_instances(collection))
+
+    assert collection.docs[0]["container_id"] == "new"
+    assert collection.docs[0]["status"] == "running"
+
+
+def test_pages_through_instances(monkeypatch):
+    collection = FakeInstances([
+        {"_id": i, "id": f"i{i}", "container_id": f"c{i}", "status": "running"} for i in range(5)
+    ])
+    calls = fake_inspect(monkeypatch, states={f"c{i}": "running" for i in range(5)})
+
+    asyncio.run(reconcile_docker_instances(collection, batch_size=2))
+
+    assert calls == [["c0", "c1"], ["c2", "c3"], ["c4"]]
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import queue
+
+import pytest
+
+from request_logging import (
+    ContextQueueHandler,
+    JsonFormatter,
+    RequestLoggingMiddleware,
+    parse_sample_rates,
+    request_id_var,
+)
+
+
+def make_app(status=200, error=None, seen_ids=None, headers=None):
+    headers = headers if headers is not None else [(b"content-type", b"text/plain")]
+
+    async def app(scope, receive, send):
+        if seen_ids is not None:
+            seen_ids.append(request_id_var.get())
+        if error is not None:
+            raise error
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"ok"})
+    return app
+
+
+def call(middleware, path="/api/environments", headers=()):
+    scope = {"type": "http", "method": "GET", "path": path, "headers": list(headers)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    return messages
+
+
+def access_records(caplog):
+    return [record for record in caplog.records if record.name == "nanobox.access"]
+
+
+def test_echoes_incoming_request_id():
+    seen = []
+    middleware = RequestLoggingMiddleware(make_app(seen_ids=seen), sample_rate=1)
+
+    messages = call(middleware, headers=[(b"x-request-id", b"abc-123")])
+
+    assert (b"x-request-id", b"abc-123") in messages[0]["headers"]
+    assert seen == ["abc-123"]
+    assert request_id_var.get() is None
+
+
+def test_response_header_list_is_not_mutated():
+    headers = [(b"content-type", b"text/plain")]
+    middleware = RequestLoggingMiddleware(make_app(headers=headers), sample_rate=0)
+
+    call(middleware)
+    call(middleware)
+
+    assert headers == [(b"content-type", b"text/plain")]
+
+
+def test_generates_request_id_when_missing():
+    messages = call(RequestLoggingMiddleware(make_app(), sample_rate=0))
+    request_id = dict(messages[0]["headers"])[b"x-request-id"]
+    assert len(request_id) == 32
+
+
+def test_successful_requests_follow_route_sample_rate(caplog):
+    middleware = RequestLoggingMiddleware(
+        make_app(), sample_rate=1, route_sample_rates={"/api/health": 0}
+    )
+
+    with caplog.at_level(logging.INFO):
+        call(middleware, path="/api/health")
+        call(middleware, path="/api/environments")
+
+    records = access_records(caplog)
+    assert [record.fields["route"] for record in records] == ["/api/environments"]
+    assert records[0].levelno == logging.INFO
+
+
+def test_server_errors_are_always_logged(caplog):
+    middleware = RequestLoggingMiddleware(make_app(status=503), sample_rate=0)
+
+    with caplog.at_level(logging.INFO):
+        call(middleware)
+
+    records = access_records(caplog)
+    assert len(records) == 1
+    assert records[0].levelno == logging.ERROR
+    assert records[0].fields["status"] == 503
+
+
+def test_unhandled_exceptions_are_logged_and_reraised(caplog):
+    middleware = RequestLoggingMiddleware(make_app(error=RuntimeError("boom")), sample_rate=0)
+
+    with caplog.at_level(logging.INFO), pytest.raises(RuntimeError):
+        call(middleware)
+
+    records = access_records(caplog)
+    assert records[0].levelno == logging.ERROR
+    assert records[0].exc_info is not None
+
+
+def test_slow_requests_are_always_logged(caplog):
+    middleware = RequestLoggingMiddleware(make_app(), sample_rate=0, slow_request_ms=0)
+
+    with caplog.at_level(logging.INFO):
+        call(middleware)
+
+    assert access_records(caplog)[0].levelno == logging.WARNING
+
+
+def test_json_formatter_output_is_valid_json():
+    record = logging.LogRecord("nanobox.access", logging.INFO, __file__, 1, 'quote " and %s', ("é",), None)
+    record.request_id = "abc"
+    record.fields = {"status": 200, "duration_ms": 1.5, "ok": True, "missing": None, "nested": {"a": [1]}}
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == 'quote " and é'
+    assert entry["request_id"] == "abc"
+    assert entry["status"] == 200 and entry["ok"] is True and entry["missing"] is None
+    assert entry["nested"] == {"a": [1]}
+    assert entry["timestamp"].endswith("Z")
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates("/api/health=0, /api/environments=0.5,bad") == {
+        "/api/health": 0.0,
+        "/api/environments": 0.5,
+    }
+
+
+def test_queued_records_keep_mutable_arguments_as_logged():
+    log_queue = queue.SimpleQueue()
+    handler = ContextQueueHandler(log_queue)
+    state = {"status": "starting"}
+    names = ["a"]
+
+    plain = logging.LogRecord("test", logging.INFO, __file__, 1, "%s took %d ms", ("env", 5), None)
+    mutable = logging.LogRecord("test", logging.INFO, __file__, 1, "state %s names %s", (state, names), None)
+    handler.handle(plain)
+    handler.handle(mutable)
+    state["status"] = "running"
+    names.append("b")
+
+    # Plain arguments stay lazy; mutable ones are rendered at the call
+    assert log_queue.get_nowait().args == ("env", 5)
+    assert log_queue.get_nowait().getMessage() == "state {'status': 'starting'} names ['a']"